@@ -0,0 +1 @@
+"""Classic Scheme benchmarks, run with python -m benchmarks.runner"""
@@ -0,0 +1,35 @@
+; Symbolic differentiation, quoted data and symbol dispatch
+(define (map f lst)
+    (if (null? lst)
+        '()
+        (cons (f (car lst)) (map f (cdr lst)))))
+(define (deriv a)
+    (cond ((pair? a)
+           (cond ((eq? (car a) '+)
+                  (cons '+ (map deriv (cdr a))))
+                 ((eq? (car a) '-)
+                  (cons '- (map deriv (cdr a))))
+                 ((eq? (car a) '*)
+                  (list '* a (cons '+ (map deriv-over (cdr a)))))
+                 ((eq? (car a) '/)
+                  (list '-
+                        (list '/ (deriv (car (cdr a))) (car (cdr (cdr a))))
+                        (list '/ (car (cdr a))
+                              (list '* (car (cdr (cdr a)))
+                                       (car (cdr (cdr a)))
+                                       (deriv (car (cdr (cdr a))))))))
+                 (else 'error)))
+          ((eq? a 'x) 1)
+          (else 0)))
+(define (deriv-over a)
+    (list '/ (deriv a) a))
+(define (count-atoms a)
+    (cond ((pair? a) (+ (count-atoms (car a)) (count-atoms (cdr a))))
+          ((null? a) 0)
+          (else 1)))
+(define (run n acc)
+    (if (= n 0)
+        acc
+        (run (- n 1)
+             (count-atoms (deriv '(+ (* 3 x x) (* a x x) (* b x) 5))))))
+(run 200 0)
@@ -0,0 +1,6 @@
+; Doubly recursive Fibonacci, mostly procedure calls and arithmetic
+(define (fib n)
+    (if (< n 2)
+        n
+        (+ (fib (- n 1)) (fib (- n 2)))))
+(fib 20)
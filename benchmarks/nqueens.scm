@@ -0,0 +1,24 @@
+; Count the solutions of the 8 queens problem, list heavy backtracking
+(define (one-to n)
+    (define (loop i acc)
+        (if (= i 0)
+            acc
+            (loop (- i 1) (cons i acc))))
+    (loop n '()))
+(define (ok? row dist placed)
+    (cond ((null? placed) #t)
+          ((= (car placed) (+ row dist)) #f)
+          ((= (car placed) (- row dist)) #f)
+          (else (ok? row (+ dist 1) (cdr placed)))))
+(define (try-it x y z)
+    (if (null? x)
+        (if (null? y) 1 0)
+        (+ (if (ok? (car x) 1 z)
+               (try-it (append (cdr x) y) '() (cons (car x) z))
+               0)
+           (try-it (cdr x) (cons (car x) y) z))))
+(define (append a b)
+    (if (null? a)
+        b
+        (cons (car a) (append (cdr a) b))))
+(try-it (one-to 8) '() '())
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""\
+Benchmark runner
+
+Every benchmark runs in a fresh interpreter process, so peak memory is
+its own. Parsing and evaluation are timed separately, the best of the
+repeats is kept. Evaluations are procedure applications, counted in a
+separate profiled run so counting does not slow the timed ones.
+
+    python -m benchmarks.runner                      # all, plain evaluator
+    python -m benchmarks.runner -e compiled fib tak
+    python -m benchmarks.runner --save benchmarks/baseline.json
+    python -m benchmarks.runner --baseline other.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+# name -> printed result, checked so a broken change is not fast by accident
+BENCHMARKS = [
+    ('fib', '6765'),
+    ('tak', '7'),
+    ('nqueens', '92'),
+    ('deriv', '43'),
+    ('sort', '#t'),
+]
+
+EVALUATORS = ('plain', 'compiled', 'explicit')
+
+def source_path(name):
+    """Path of benchmark program"""
+    return os.path.join(ROOT, 'benchmarks', name + '.scm')
+
+def evaluate_forms(pyscm, evaluator, forms, env):
+    """Expand and evaluate parsed forms with one of the evaluators"""
+    result = None
+    macros = pyscm.get_macros(env)
+    for exp in forms:
+        exp = pyscm.expand(exp, macros)
+        if evaluator == 'plain':
+            result = pyscm.evaluate(exp, env)
+        elif evaluator == 'compiled':
+            result = pyscm.analyze(exp)(env)
+        else:
+            result = pyscm.evaluate_explicit(exp, env)
+    return result
+
+def count_applications(pyscm, source):
+    """Procedure applications made by running source once"""
+    profiler = pyscm.Profiler()
+    pyscm.run_compiled(source, pyscm.make_base(), profiler=profiler)
+    return sum(calls for calls, _, _ in profiler.stats.values())
+
+def measure(name, evaluator, repeat):
+    """Time one benchmark in this process, return dict of results"""
+    sys.path.insert(0, ROOT)
+    import pyscm
+    source = open(source_path(name)).read()
+    parse_time = eval_time = None
+    for _ in range(repeat):
+        start = default_timer()
+        forms = list(pyscm.read(source))
+        elapsed = default_timer() - start
+        parse_time = min(elapsed, parse_time or elapsed)
+        env = pyscm.make_base()
+        start = default_timer()
+        result = evaluate_forms(pyscm, evaluator, forms, env)
+        elapsed = default_timer() - start
+        eval_time = min(elapsed, eval_time or elapsed)
+    return {
+        'parse': parse_time,
+        'eval': eval_time,
+        'applications': count_applications(pyscm, source),
+        'result': pyscm.to_string(result),
+        # kilobytes on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def run_child(name, evaluator, repeat):
+    """Measure benchmark in a subprocess"""
+    output = subprocess.check_output([sys.executable, '-m',
+        'benchmarks.runner', '--child', '-e', evaluator, '-r', str(repeat),
+        name], cwd=ROOT)
+    return json.loads(output)
+
+def compare(name, stats, baseline, threshold):
+    """Describe change against baseline, flag slowdowns over threshold"""
+    old = baseline.get(name)
+    if old is None:
+        return '', False
+    ratio = stats['eval'] / old['eval']
+    regressed = ratio > 1 + threshold
+    return ('%+.1f%%%s' % ((ratio - 1) * 100, ' REGRESSION' if regressed
+        else '')), regressed
+
+def main(argv=None):
+    """Run benchmarks, return exit status"""
+    parser = argparse.ArgumentParser(description='Run pyScm benchmarks')
+    parser.add_argument('names', nargs='*',
+        help='benchmarks to run, all by default')
+    parser.add_argument('-e', '--evaluator', choices=EVALUATORS,
+        default='plain')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE,
+        help='JSON file to compare against, benchmarks/baseline.json by '
+        'default')
+    parser.add_argument('--save', help='write results as JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='eval slowdown flagged as regression, 0.1 is 10%%')
+    parser.add_argument('--child', action='store_true',
+        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        json.dump(measure(args.names[0], args.evaluator, args.repeat),
+            sys.stdout)
+        return 0
+
+    expected = dict(BENCHMARKS)
+    names = args.names or [name for name, _ in BENCHMARKS]
+    baseline = {}
+    if os.path.exists(args.baseline):
+        baseline = json.load(open(args.baseline)).get(args.evaluator, {})
+    results = {}
+    failed = False
+    print '%-10s %10s %10s %12s %10s  %s' % ('benchmark', 'parse (s)',
+        'eval (s)', 'evals/s', 'rss (KB)', 'vs baseline')
+    for name in names:
+        stats = results[name] = run_child(name, args.evaluator, args.repeat)
+        change, regressed = compare(name, stats, baseline, args.threshold)
+        if stats['result'] != expected[name]:
+            change = 'WRONG RESULT %s' % stats['result']
+            regressed = True
+        failed = failed or regressed
+        print '%-10s %10.4f %10.4f %12.0f %10d  %s' % (name, stats['parse'],
+            stats['eval'], stats['applications'] / stats['eval'],
+            stats['peak_rss'], change)
+
+    if args.save:
+        saved = {}
+        if os.path.exists(args.save):
+            saved = json.load(open(args.save))
+        saved.setdefault(args.evaluator, {}).update(results)
+        with open(args.save, 'w') as f:
+            json.dump(saved, f, indent=2, sort_keys=True,
+                separators=(',', ': '))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
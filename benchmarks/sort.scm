@@ -0,0 +1,35 @@
+; Merge sort of a pseudo random list of integers
+(define (random-list n seed acc)
+    (if (= n 0)
+        acc
+        (random-list (- n 1)
+                     (modulo (+ (* seed 1103515245) 12345) 2147483648)
+                     (cons seed acc))))
+(define (modulo a b)
+    (- a (* b (/ a b))))
+(define (split lst left right)
+    (if (null? lst)
+        (cons left right)
+        (split (cdr lst) right (cons (car lst) left))))
+(define (reverse-onto lst acc)
+    (if (null? lst)
+        acc
+        (reverse-onto (cdr lst) (cons (car lst) acc))))
+(define (merge a b acc)
+    (cond ((null? a) (reverse-onto acc b))
+          ((null? b) (reverse-onto acc a))
+          ((< (car a) (car b)) (merge (cdr a) b (cons (car a) acc)))
+          (else (merge a (cdr b) (cons (car b) acc)))))
+(define (sort lst)
+    (if (null? lst)
+        lst
+        (if (null? (cdr lst))
+            lst
+            (let ((halves (split lst '() '())))
+                (merge (sort (car halves)) (sort (cdr halves)) '())))))
+(define (sorted? lst)
+    (cond ((null? lst) #t)
+          ((null? (cdr lst)) #t)
+          ((> (car lst) (car (cdr lst))) #f)
+          (else (sorted? (cdr lst)))))
+(sorted? (sort (random-list 2000 42 '())))
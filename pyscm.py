@@ -10,73 +10,282 @@ I NEED A JOB!
 
 """
 
+__version__ = '0.2'
+
+import argparse
+import copy_reg
+import cPickle
+import hashlib
+import json
+import multiprocessing
+import operator
+import os
+import py_compile
+import Queue
 import re
 import sys
+import tempfile
+import threading
+import urlparse
+import weakref
+from array import array
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from contextlib import contextmanager
+from cStringIO import StringIO
+from itertools import imap, izip, repeat
+from timeit import default_timer
+from types import FunctionType
+
+try:
+    import numpy
+    # element-wise operators numpy can run over a whole buffer
+    NUMPY_UFUNCS = {
+        operator.add: numpy.add,
+        operator.sub: numpy.subtract,
+        operator.mul: numpy.multiply,
+    }
+except ImportError:
+    numpy = None
+    NUMPY_UFUNCS = {}
+
+# group 1 is the token, whitespace and comments match without it; a string
+# literal missing its closing quote is still matched, so it can be
+# completed by the next line
+TOKEN_PATTERN = re.compile(
+    r'''\s+|;[^\n]*|("(?:[^"\\]|\\.)*"?|[()']|[^\s()'";]+)''', re.S)
+STRING_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*"\Z', re.S)
+INTEGER_PATTERN = re.compile(r'[+-]?\d+\Z')
+NUMBER_PATTERN = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?\Z')
+ESCAPE_PATTERN = re.compile(r'\\(.)', re.S)
+ATOM_CACHE_SIZE = 4096
+MEMOIZE_SIZE = 1024
+# parsed files, keyed by interpreter version and source hash
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pyscm')
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r'}
+
+def tokenize(source):
+    """Split Scheme code into tokens
+
+    source is a string or a file-like object, which is consumed line by
+    line. Unicode is encoded to UTF-8, so tokens are always str.
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    if isinstance(source, str):
+        source = StringIO(source)
+    pending = ''
+    for chunk in source:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        if pending:
+            chunk = pending + chunk
+            pending = ''
+        for token in TOKEN_PATTERN.findall(chunk):
+            if not token:
+                continue
+            if token[0] == '"' and not STRING_PATTERN.match(token):
+                # unterminated string always runs to the end of the chunk
+                pending = token
+                break
+            yield token
+    if pending:
+        raise Exception('Unterminated string : ' + pending)
+
+def read(source):
+    """Yield top-level forms of Scheme code one at a time"""
+    # open lists, None marks a pending quote
+    stack = []
+    # recently converted atoms, repeated tokens are converted only once
+    atoms = {}
+    for token in tokenize(source):
+        if token == '(':
+            stack.append([])
+            continue
+        elif token == "'":
+            stack.append(None)
+            continue
+        elif token == ')':
+            if not stack or stack[-1] is None:
+                raise Exception('Unexpected )')
+            exp = stack.pop()
+        else:
+            exp = atoms.get(token)
+            if exp is None:
+                if len(atoms) > ATOM_CACHE_SIZE:
+                    atoms.clear()
+                exp = atoms[token] = read_atom(token)
+        # deal with quoting
+        while stack and stack[-1] is None:
+            stack.pop()
+            exp = ['quote', exp]
+        if stack:
+            stack[-1].append(exp)
+        else:
+            yield exp
+    if stack:
+        raise Exception('Unexpected end of input')
+
+def read_atom(token):
+    """Convert token to a number, String, boolean or interned identifier"""
+    c = token[0]
+    if c == '"' or c in '0123456789+-.':
+        value = eval_primitive(token)
+        if value is not None:
+            return value
+    elif token == '#t':
+        return TRUE
+    elif token == '#f':
+        return FALSE
+    return intern(str(token))
 
 def parse(code):
     """Transform Scheme code to Python list"""
-    pieces = re.split(r'(\s|\(|\)|\')', code)
-    pieces = [p for p in pieces if not re.match(r'^\s*$', p)]
-    ast = [[]]
-    for p in pieces:
-        if p == '(':
-            ast.append([])
-        elif p == ')':
-            lst = ast.pop() 
-            if not ast[-1] or ast[-1][-1] != "'":
-                ast[-1].append(lst)
-            # deal with quoting
-            else:
-                ast[-1].pop()
-                ast[-1].append(['quote', lst])
-        else:
-            if not ast[-1] or ast[-1][-1] != "'":
-                ast[-1].append(p)
-            # deal with quoting
-            else:
-                ast[-1].pop()
-                ast[-1].append(['quote', p])
-    ast = ast[0]
+    ast = list(read(code))
     ast.insert(0, 'begin')
     return ast
 
 def pylist_to_pairs(lst):
-    """Convert nested list to pairs"""
+    """Convert nested list to pairs
+
+    Nested lists are kept on a stack rather than recursed into, so data
+    of any depth can be converted.
+    """
     if not isinstance(lst, list):
-        # violate SRP, but I dont care
-        if is_primitive(lst):
-            return eval_primitive(lst)
-        else:
+        # literals are converted by the reader already
+        if is_identifier(lst):
             return make_symbol(lst)
-    elif len(lst) == 0:
-        return []
-    else:
-        return [pylist_to_pairs(lst[0]), pylist_to_pairs(lst[1:])]
+        else:
+            return lst
+    # each entry is a list, how many of its items are left, and the pairs
+    # built from its end so far
+    stack = [[lst, len(lst), NIL]]
+    while True:
+        entry = stack[-1]
+        if entry[1] == 0:
+            stack.pop()
+            if not stack:
+                return entry[2]
+            stack[-1][2] = Pair(entry[2], stack[-1][2])
+            continue
+        entry[1] -= 1
+        item = entry[0][entry[1]]
+        if isinstance(item, list):
+            stack.append([item, len(item), NIL])
+        elif is_identifier(item):
+            entry[2] = Pair(make_symbol(item), entry[2])
+        else:
+            entry[2] = Pair(item, entry[2])
 
-def map_recursively(lst, func):
-    """Map recursively"""
-    if not isinstance(lst, list):
-        return func(lst)
-    elif lst == []:
-        return lst
-    else:
-        result = [map_recursively(lst[0], func)]
-        result.extend(map_recursively(lst[1:], func))
-        return result
+def pairs_to_pylist(pairs):
+    """Collect elements of a proper list into a Python list"""
+    return list(pairs)
+
+def to_string(obj, atom=str):
+    """External representation of Scheme object, atom gives the one of
+    each atom
+    """
+    if not isinstance(obj, (Pair, Vector)):
+        return atom(obj)
+    out = StringIO()
+    write_object(obj, out, atom)
+    return out.getvalue()
+
+def write_atom(obj):
+    """Representation of atom that reads back, strings are quoted"""
+    if isinstance(obj, String):
+        return '"' + obj.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return str(obj)
+
+# pieces of output joined before each write to the port
+WRITE_CHUNK = 4096
+
+# entries of the printer's stack
+PRINT_OBJECT, PRINT_REST, PRINT_ITEMS, PRINT_TEXT = range(4)
+
+def write_object(obj, out, atom=str):
+    """Write external representation of Scheme object to port
+
+    Lists and vectors are walked with an explicit stack, so nesting depth
+    and length only cost memory, and the text is written in chunks as it
+    is produced instead of being built whole.
+    """
+    if not isinstance(obj, (Pair, Vector)):
+        out.write(atom(obj))
+        return
+    chunk = []
+    stack = [(PRINT_OBJECT, obj)]
+    while stack:
+        kind, x = stack.pop()
+        if kind == PRINT_OBJECT:
+            if isinstance(x, Vector):
+                chunk.append('#(')
+                items = iter(x)
+                for item in items:
+                    stack.append((PRINT_ITEMS, items))
+                    stack.append((PRINT_OBJECT, item))
+                    break
+                else:
+                    chunk.append(')')
+                continue
+            elif not isinstance(x, Pair):
+                chunk.append(atom(x))
+                continue
+            chunk.append('(')
+        elif kind == PRINT_REST:
+            # x is what follows an element printed in a list
+            if x is NIL:
+                chunk.append(')')
+                continue
+            elif not isinstance(x, Pair):
+                chunk.append(' . ')
+                stack.append((PRINT_TEXT, ')'))
+                stack.append((PRINT_OBJECT, x))
+                continue
+            chunk.append(' ')
+        elif kind == PRINT_ITEMS:
+            # x is an iterator over the vector items left
+            for item in x:
+                chunk.append(' ')
+                stack.append((PRINT_ITEMS, x))
+                stack.append((PRINT_OBJECT, item))
+                break
+            else:
+                chunk.append(')')
+            continue
+        else:
+            chunk.append(x)
+            continue
+        # x is a pair, run along the list while its elements are atoms
+        while True:
+            car = x.car
+            if isinstance(car, (Pair, Vector)):
+                stack.append((PRINT_REST, x.cdr))
+                stack.append((PRINT_OBJECT, car))
+                break
+            chunk.append(atom(car))
+            x = x.cdr
+            if len(chunk) >= WRITE_CHUNK:
+                out.write(''.join(chunk))
+                del chunk[:]
+            if x.__class__ is not Pair:
+                stack.append((PRINT_REST, x))
+                break
+            chunk.append(' ')
+        if len(chunk) >= WRITE_CHUNK:
+            out.write(''.join(chunk))
+            del chunk[:]
+    out.write(''.join(chunk))
 
 # Predicators
 
 def is_number(exp):
     """Are you a number?"""
-    try:
-        float(exp)
-        return True
-    except ValueError:
-        return False
+    return NUMBER_PATTERN.match(exp) is not None
 
 def is_string(exp):
     """Are you a string?"""
-    if exp[0] == exp[-1] == '"':
+    if len(exp) > 1 and exp[0] == exp[-1] == '"':
         return True
 
 def is_primitive(exp):
@@ -89,6 +298,15 @@ def is_primitive(exp):
         return True
     return False
 
+def is_self_evaluating(exp):
+    """Are you a literal converted by the reader (or any other value)?"""
+    cls = exp.__class__
+    return cls is not str and cls is not list
+
+def is_identifier(exp):
+    """Are you a variable name in parsed code?"""
+    return exp.__class__ is str
+
 def is_tagged_list(exp, tag):
     """Is your first element 'tag'?"""
     return isinstance(exp, list) and len(exp) > 0 and exp[0] == tag
@@ -125,6 +343,10 @@ def is_if(exp):
     """Are you a if?"""
     return is_tagged_list(exp, 'if')
 
+def is_memoized_definition(exp):
+    """Are you a memoized definition?"""
+    return is_tagged_list(exp, 'define-memoized')
+
 def is_let(exp):
     """Are you a let?"""
     return is_tagged_list(exp, 'let')
@@ -133,76 +355,583 @@ def is_cond(exp):
     """Are you a cond?"""
     return is_tagged_list(exp, 'cond')
 
+def is_delay(exp):
+    """Are you a delay?"""
+    return is_tagged_list(exp, 'delay')
+
+def is_cons_stream(exp):
+    """Are you a cons-stream?"""
+    return is_tagged_list(exp, 'cons-stream')
+
 # Primitive functions
 
 def display(args):
-    """Output to stdout"""
-    sys.stdout.write(str(map_recursively(args[0], str)))
+    """Output to the port of the running Interpreter, stdout by default"""
+    write_object(args[0], _state.out or sys.stdout)
+
+# the common two argument case skips reduce
 
 def add(args):
     """+"""
-    return reduce(lambda x,y:x+y, args, 0)
+    if len(args) == 2:
+        return args[0] + args[1]
+    return reduce(operator.add, args, 0)
 
 def sub(args):
     """-"""
-    return reduce(lambda x,y:x-y, args)
+    if len(args) == 2:
+        return args[0] - args[1]
+    return reduce(operator.sub, args)
 
 def mul(args):
     """*"""
-    return reduce(lambda x,y:x*y, args, 1)
+    if len(args) == 2:
+        return args[0] * args[1]
+    return reduce(operator.mul, args, 1)
 
 def div(args):
     """/"""
-    return reduce(lambda x,y:x/y, args)
+    if len(args) == 2:
+        return args[0] / args[1]
+    return reduce(operator.div, args)
 
 def lt(args):
     """<"""
-    return make_boolean(args[0] < args[1])
+    return TRUE if args[0] < args[1] else FALSE
 
 def gt(args):
     """>"""
-    return make_boolean(args[0] > args[1])
+    return TRUE if args[0] > args[1] else FALSE
 
 def le(args):
     """<="""
-    return make_boolean(args[0] <= args[1])
+    return TRUE if args[0] <= args[1] else FALSE
 
 def ge(args):
     """>="""
-    return make_boolean(args[0] >= args[1])
+    return TRUE if args[0] >= args[1] else FALSE
 
 def eq(args):
     """="""
-    return make_boolean(args[0] == args[1])
+    return TRUE if args[0] == args[1] else FALSE
 
 def eq_question_mark(args):
     """eq?"""
-    if (args[0] == [] and args[1] == []):
-        return make_boolean(True)
-    return make_boolean(args[0] is args[1])
+    return TRUE if args[0] is args[1] else FALSE
+
+# Positional versions, used by analyzed code to skip the argument list
+
+def binary_lt(x, y):
+    """< on two arguments"""
+    return TRUE if x < y else FALSE
+
+def binary_gt(x, y):
+    """> on two arguments"""
+    return TRUE if x > y else FALSE
+
+def binary_le(x, y):
+    """<= on two arguments"""
+    return TRUE if x <= y else FALSE
+
+def binary_ge(x, y):
+    """>= on two arguments"""
+    return TRUE if x >= y else FALSE
+
+def binary_eq(x, y):
+    """= on two arguments"""
+    return TRUE if x == y else FALSE
+
+def binary_eq_question_mark(x, y):
+    """eq? on two arguments"""
+    return TRUE if x is y else FALSE
+
+def unary_null_question_mark(x):
+    """null? on one argument"""
+    return TRUE if x is NIL else FALSE
 
 def cons(args):
     """cons"""
-    return [args[0], args[1]]
+    budget = current_budget()
+    if budget is not None:
+        budget.allocate(1)
+    return Pair(args[0], args[1])
+
+def binary_cons(x, y):
+    """cons on two arguments, charged like cons even from code analyzed
+    outside a budget
+    """
+    if _budgets:
+        budget = _state.budget
+        if budget is not None:
+            budget.allocate(1)
+    return Pair(x, y)
 
 def cdr(args):
     """cdr"""
-    return args[0][1]
+    return args[0].cdr
 
 def car(args):
     """car"""
-    return args[0][0]
+    return args[0].car
+
+def make_list(args):
+    """list"""
+    budget = current_budget()
+    if budget is not None:
+        budget.allocate(len(args))
+    result = NIL
+    for item in reversed(args):
+        result = Pair(item, result)
+    return result
+
+def null_question_mark(args):
+    """null?"""
+    return TRUE if args[0] is NIL else FALSE
+
+def pair_question_mark(args):
+    """pair?"""
+    return TRUE if isinstance(args[0], Pair) else FALSE
+
+# Vectors
+
+def is_sequence_operand(operand):
+    """Is it vector storage, rather than a scalar?"""
+    return isinstance(operand, (array, list))
+
+def is_float_operand(operand):
+    """Can numpy use it without conversion?"""
+    if operand.__class__ is array:
+        return operand.typecode == 'd'
+    return isinstance(operand, (int, long, float))
+
+def vectorized(op, *operands):
+    """Apply op across vector storages, scalars are broadcast and the
+    shortest storage sets the length, like izip
+
+    The loop runs in C: in numpy for float arrays, otherwise in imap.
+    """
+    length = min(len(o) for o in operands if is_sequence_operand(o))
+    if numpy is not None and op in NUMPY_UFUNCS and \
+            all(is_float_operand(o) for o in operands):
+        views = [numpy.frombuffer(o, dtype=numpy.float64)[:length]
+            if o.__class__ is array else o for o in operands]
+        return array('d', NUMPY_UFUNCS[op](*views).tostring())
+    return list(imap(op, *[o if is_sequence_operand(o)
+        else repeat(o, length) for o in operands]))
+
+def make_vector(args):
+    """make-vector"""
+    fill = args[1] if len(args) > 1 else 0
+    return Vector(repeat(fill, args[0]))
+
+def vector(args):
+    """vector"""
+    return Vector(args)
+
+def vector_question_mark(args):
+    """vector?"""
+    return TRUE if isinstance(args[0], Vector) else FALSE
+
+def vector_ref(args):
+    """vector-ref"""
+    return args[0].ref(args[1])
+
+def vector_set(args):
+    """vector-set!"""
+    args[0].set(args[1], args[2])
+
+def vector_length(args):
+    """vector-length"""
+    return len(args[0])
+
+def list_to_vector(args):
+    """list->vector"""
+    return Vector(args[0])
+
+def vector_to_list(args):
+    """vector->list"""
+    return make_list(list(args[0]))
+
+def vector_map(args):
+    """vector-map, primitives run over whole buffers"""
+    proc = args[0]
+    vectors = args[1:]
+    if proc.__class__ is PrimitiveFunction and proc.arity == len(vectors):
+        return Vector(vectorized(proc.fast, *[v.items for v in vectors]))
+    return Vector([apply_procedure(proc, list(xs)) for xs in izip(*vectors)])
+
+def vector_fold(args):
+    """vector-fold, (kons state element) from left to right"""
+    proc, state, v = args
+    if proc.__class__ is PrimitiveFunction and proc.arity == 2:
+        return reduce(proc.fast, v.items, state)
+    for x in v.items:
+        state = apply_procedure(proc, [state, x])
+    return state
+
+# Hash tables
+
+def make_hash_table(args):
+    """make-hash-table"""
+    return HashTable()
+
+def hash_table_ref(args):
+    """hash-table-ref, calls the optional thunk for a missing key"""
+    table, key = args[0], args[1]
+    if len(args) > 2 and HashTable.key(key) not in table.table:
+        return apply_procedure(args[2], [])
+    return table.ref(key)
+
+def hash_table_ref_default(args):
+    """hash-table-ref/default"""
+    entry = args[0].table.get(HashTable.key(args[1]))
+    return args[2] if entry is None else entry[1]
+
+def hash_table_set(args):
+    """hash-table-set!"""
+    args[0].table[HashTable.key(args[1])] = (args[1], args[2])
+
+def hash_table_delete(args):
+    """hash-table-delete!"""
+    args[0].table.pop(HashTable.key(args[1]), None)
+
+def hash_table_exists(args):
+    """hash-table-exists?"""
+    return TRUE if HashTable.key(args[1]) in args[0].table else FALSE
+
+def hash_table_count(args):
+    """hash-table-count"""
+    return len(args[0].table)
+
+def hash_table_walk(args):
+    """hash-table-walk, (proc key value) for every entry"""
+    table, proc = args
+    # values() is a copy, proc may modify the table
+    for key, value in table.table.values():
+        apply_procedure(proc, [key, value])
+
+# Memoization
+
+def memoize(args):
+    """memoize, with optional maximum cache size"""
+    if len(args) > 1:
+        if not isinstance(args[1], (int, long)) or args[1] < 1:
+            raise Exception('Memoize size must be a positive integer : '
+                + to_string(args[1]))
+        return MemoizedProcedure(args[0], args[1])
+    return MemoizedProcedure(args[0])
+
+def memo_stats(args):
+    """memo-stats, association list of cache statistics"""
+    stats = args[0].get_stats()
+    return make_list([Pair(make_symbol(k), stats[k])
+        for k in ('hits', 'misses', 'size', 'max-size')])
+
+def memo_clear(args):
+    """memo-clear!"""
+    args[0].cache.clear()
+
+# Streams
+
+def force(args):
+    """force, anything but a promise is its own value"""
+    if isinstance(args[0], Promise):
+        return args[0].force()
+    return args[0]
+
+def stream_cdr(args):
+    """stream-cdr"""
+    return args[0].cdr.force()
+
+def stream_items(stream):
+    """Iterate over elements, forcing one promise at a time"""
+    while stream is not NIL:
+        yield stream.car
+        stream = stream.cdr.force()
+
+def map_stream(proc, promise):
+    """Stream of proc applied to the stream promised"""
+    stream = promise.force()
+    if stream is NIL:
+        return NIL
+    return Pair(apply_procedure(proc, [stream.car]),
+        Promise(map_stream, proc, stream.cdr))
+
+def filter_stream(proc, promise):
+    """Stream of the elements of the stream promised passing proc"""
+    stream = promise.force()
+    while stream is not NIL:
+        if apply_procedure(proc, [stream.car]) is TRUE:
+            return Pair(stream.car, Promise(filter_stream, proc, stream.cdr))
+        stream = stream.cdr.force()
+    return NIL
+
+def stream_map(args):
+    """stream-map over one stream"""
+    return map_stream(args[0], Promise(None, args[1]))
+
+def stream_filter(args):
+    """stream-filter"""
+    return filter_stream(args[0], Promise(None, args[1]))
+
+def stream_for_each(args):
+    """stream-for-each, keeps nothing of the stream already seen"""
+    proc, stream = args
+    # the caller's argument list would hold the head of the stream
+    args[1] = None
+    while stream is not NIL:
+        apply_procedure(proc, [stream.car])
+        stream = stream.cdr.force()
+
+def stream_to_list(args):
+    """stream->list, of the first args[1] elements if given"""
+    items = stream_items(args[0])
+    if len(args) > 1:
+        items = (item for _, item in izip(xrange(args[1]), items))
+    return make_list(list(items))
+
+def read_line_stream(f):
+    """Stream of the lines left in file, closed at the end"""
+    line = f.readline()
+    if not line:
+        f.close()
+        return NIL
+    return Pair(String(line.rstrip('\n')), Promise(read_line_stream, f))
+
+def read_lines(args):
+    """read-lines, stream of the lines of a file read as it is forced"""
+    return read_line_stream(open(args[0]))
 
 # Classes
 
+class Pair(object):
+    """Cons cell"""
+
+    __slots__ = ('car', 'cdr')
+
+    def __init__(self, car, cdr):
+        """Initialize with car and cdr"""
+        self.car = car
+        self.cdr = cdr
+
+    def __iter__(self):
+        """Iterate over elements of a proper list"""
+        pair = self
+        while pair.__class__ is Pair:
+            yield pair.car
+            pair = pair.cdr
+        if pair is not NIL:
+            raise Exception('Not a proper list : ' + to_string(self))
+
+    def __str__(self):
+        """Serialize to string"""
+        return to_string(self)
+
+    def __reduce__(self):
+        """Pickle the spine as one Python list, as cPickle would recurse
+        once per cdr; a circular spine is pickled pair by pair
+        """
+        items = []
+        seen = set()
+        pair = self
+        while pair.__class__ is Pair:
+            if id(pair) in seen:
+                return (copy_reg.__newobj__, (Pair,),
+                    (None, {'car': self.car, 'cdr': self.cdr}))
+            seen.add(id(pair))
+            items.append(pair.car)
+            pair = pair.cdr
+        return (build_list, (items, pair))
+
+def build_list(items, tail):
+    """Pairs of items ending with tail, how pickled lists are restored"""
+    result = tail
+    for item in reversed(items):
+        result = Pair(item, result)
+    return result
+
+class EmptyList(object):
+    """The empty list, NIL is its only instance"""
+
+    __slots__ = ()
+
+    def __iter__(self):
+        """No element"""
+        return iter(())
+
+    def __str__(self):
+        """Serialize to string"""
+        return '()'
+
+    def __reduce__(self):
+        """Unpickle as the module singleton"""
+        return 'NIL'
+
+NIL = EmptyList()
+
+# homogeneous vectors of these types are kept in typed arrays
+ARRAY_TYPECODES = {int: 'l', float: 'd'}
+ARRAY_TYPES = {'l': int, 'd': float}
+
+def make_storage(items):
+    """Pack homogeneous numbers into a typed array, anything else in a list"""
+    if not isinstance(items, list):
+        items = list(items)
+    if items:
+        types = set(map(type, items))
+        if len(types) == 1:
+            typecode = ARRAY_TYPECODES.get(types.pop())
+            if typecode is not None:
+                try:
+                    return array(typecode, items)
+                except OverflowError:
+                    pass
+    return items
+
+class Vector(object):
+    """Fixed length vector, numeric ones are backed by array buffers
+
+    Arithmetic operators work element-wise with another vector of the same
+    length, or with a number, so + and * on vectors need no Scheme loop.
+    """
+
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        """Initialize with elements (any iterable)"""
+        self.items = make_storage(items)
+
+    def __len__(self):
+        """Vector length"""
+        return len(self.items)
+
+    def __iter__(self):
+        """Iterate over elements"""
+        return iter(self.items)
+
+    def ref(self, i):
+        """Get element"""
+        return self.items[i]
+
+    def set(self, i, value):
+        """Set element, falling back to a list if it does not fit the array"""
+        items = self.items
+        if items.__class__ is array:
+            if value.__class__ is ARRAY_TYPES[items.typecode]:
+                try:
+                    items[i] = value
+                    return
+                except OverflowError:
+                    pass
+            self.items = items = list(items)
+        items[i] = value
+
+    def elementwise(self, other, op, reflected=False):
+        """Apply binary operator to each element and other (or its elements)"""
+        a = self.items
+        if isinstance(other, Vector):
+            b = other.items
+            if len(a) != len(b):
+                raise Exception('Vector lengths differ : %d and %d'
+                    % (len(a), len(b)))
+        else:
+            b = other
+        if reflected:
+            a, b = b, a
+        return Vector(vectorized(op, a, b))
+
+    def __add__(self, other):
+        return self.elementwise(other, operator.add)
+
+    def __radd__(self, other):
+        return self.elementwise(other, operator.add, True)
+
+    def __sub__(self, other):
+        return self.elementwise(other, operator.sub)
+
+    def __rsub__(self, other):
+        return self.elementwise(other, operator.sub, True)
+
+    def __mul__(self, other):
+        return self.elementwise(other, operator.mul)
+
+    def __rmul__(self, other):
+        return self.elementwise(other, operator.mul, True)
+
+    def __div__(self, other):
+        return self.elementwise(other, operator.div)
+
+    def __rdiv__(self, other):
+        return self.elementwise(other, operator.div, True)
+
+    def __str__(self):
+        """Serialize to string"""
+        return to_string(self)
+
+
+class HashTable(object):
+    """Mutable mapping backed by a dict
+
+    Numbers and strings are keyed by value, symbols by identity (they are
+    interned), anything else like pairs by identity. Entries are (key,
+    value) pairs under the dict key of their key.
+    """
+
+    __slots__ = ('table',)
+
+    def __init__(self):
+        """Initialize empty"""
+        self.table = {}
+
+    @staticmethod
+    def key(key):
+        """Dict key of key, numbers keep whether they are exact so 1
+        and 1.0 differ
+        """
+        cls = key.__class__
+        if cls is int or cls is long:
+            return (int, key)
+        elif cls is float:
+            return (float, key)
+        return key
+
+    def ref(self, key):
+        """Get value of key"""
+        try:
+            return self.table[HashTable.key(key)][1]
+        except KeyError:
+            raise Exception('Key not found : ' + to_string(key))
+
+    def __str__(self):
+        """Serialize to string"""
+        return '#<hash-table %d>' % len(self.table)
+
 class Lambda(object):
-    """Lambda function object"""
+    """Lambda function object
+
+    It holds its whole parent environment, as made by evaluate and the
+    explicit-control evaluator, so every binding of the frames around it
+    lives as long as it does. Only run_compiled's closures capture just
+    the variables they use, see CompiledLambda.
+    """
+
+    # tiering state, see specialize
+    calls = 0
+    specialized = None
+    signature = None
+    deopts = 0
 
-    def __init__(self, paras, body, parent_env):
+    def __init__(self, paras, body, parent_env, name=None):
         """Initialize with parameters, body, and parent environment"""
         self.__paras = paras
         self.__body = body
+        # the body as one expression, built once rather than on each call
+        if len(body) == 1:
+            self.__sequence = body[0]
+        else:
+            self.__sequence = ['begin'] + body
         self.__parent_env = parent_env
+        self.__name = name
 
     @staticmethod
     def make(lst, env):
@@ -217,21 +946,174 @@ class Lambda(object):
         """Get function body"""
         return self.__body
 
+    def get_sequence(self):
+        """Get function body as one expression"""
+        return self.__sequence
+
+    def __getstate__(self):
+        """Pickle without the specialized version, it is Python code"""
+        state = self.__dict__.copy()
+        for name in ('calls', 'specialized', 'signature', 'deopts'):
+            state.pop(name, None)
+        return state
+
     def get_parent_env(self):
         """Get parent environment"""
         return self.__parent_env
 
+    def get_name(self):
+        """Get name it was defined with, None if anonymous"""
+        return self.__name
+
+    def set_name(self, name):
+        """Set name"""
+        self.__name = name
+
 class PrimitiveFunction(object):
     """Simply invoke python function"""
 
-    def __init__(self, func):
-        """Initialize with python function object"""
+    def __init__(self, func, fast=None, arity=None):
+        """Initialize with python function object
+
+        fast is an optional version taking exactly arity arguments
+        positionally, analyzed code calls it directly when it can
+        """
         self.__func = func
+        self.fast = fast
+        self.arity = arity
+        self.name = None
 
     def apply(self, args):
         """Same interface with Lambda"""
         return self.__func(args) 
 
+    def get_func(self):
+        """Get python function"""
+        return self.__func
+
+def memo_key(value):
+    """Hashable key with the same value for equal arguments
+
+    Numbers keep their type so 1 and 1.0 differ, lists are compared by
+    contents, symbols and other objects by identity.
+    """
+    cls = value.__class__
+    if cls is int or cls is long or cls is float:
+        return (cls, value)
+    elif cls is Pair:
+        items = []
+        while value.__class__ is Pair:
+            items.append(memo_key(value.car))
+            value = value.cdr
+        return (Pair, tuple(items), memo_key(value))
+    return value
+
+class MemoizedProcedure(PrimitiveFunction):
+    """Procedure caching its results by argument values
+
+    At most max_size results are kept, the least recently used goes first.
+    """
+
+    def __init__(self, proc, max_size=MEMOIZE_SIZE):
+        """Initialize with procedure to wrap"""
+        PrimitiveFunction.__init__(self, self.call)
+        self.proc = proc
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def call(self, args):
+        """Look up the cache before applying the procedure"""
+        key = tuple(map(memo_key, args))
+        cache = self.cache
+        try:
+            # popped and stored again to become the most recent
+            value = cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            value = apply_procedure(self.proc, args)
+            if len(cache) >= self.max_size:
+                cache.popitem(last=False)
+        cache[key] = value
+        return value
+
+    def get_stats(self):
+        """Get cache statistics"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.cache), 'max-size': self.max_size}
+
+    def __reduce__(self):
+        """Pickle the wrapped procedure and cache, not the bound method
+
+        The procedure goes in the state, it may refer back to this one.
+        """
+        return (MemoizedProcedure, (None, self.max_size), {
+            'proc': self.proc, 'cache': self.cache, 'hits': self.hits,
+            'misses': self.misses, 'name': self.name})
+
+class AsyncPrimitive(PrimitiveFunction):
+    """Primitive returning an awaitable, anything with done(), result()
+    and add_done_callback() like Future
+
+    run_async suspends the program until it is done, other evaluators
+    block the thread until something else, like another thread, finishes
+    it.
+    """
+
+    def __init__(self, start):
+        """Initialize with python function returning an awaitable"""
+        PrimitiveFunction.__init__(self,
+            lambda args: wait_result(start(args)))
+        self.start = start
+
+def wait_result(awaitable):
+    """Block until awaitable is done, then get its result"""
+    if not awaitable.done():
+        finished = threading.Event()
+        awaitable.add_done_callback(lambda _: finished.set())
+        # Future has no lock, it may finish while the callback is added
+        while not (finished.wait(0.1) or awaitable.done()):
+            pass
+    return awaitable.result()
+
+class Promise(object):
+    """Delayed application of func to args, forced at most once
+
+    Without func the promise is already forced, args[0] is its value.
+    """
+
+    __slots__ = ('func', 'args', 'value')
+
+    def __init__(self, func, *args):
+        """Initialize with function and arguments to apply it to"""
+        self.func = func
+        self.args = args
+        self.value = args[0] if func is None else None
+
+    def force(self):
+        """Value, computed on the first call"""
+        if self.func is not None:
+            value = self.func(*self.args)
+            # forcing may have forced this promise already
+            if self.func is not None:
+                self.value = value
+                # let what the computation needed go
+                self.func = self.args = None
+        return self.value
+
+    def __str__(self):
+        """Serialize to string"""
+        return '#<promise>'
+
+class String(str):
+    """String literal in parsed code, not to be taken for an identifier"""
+
+    def __repr__(self):
+        """Show like Scheme source"""
+        return 'String(%s)' % str.__repr__(self)
+
 class Symbol(object):
     """A symbol is simply a string that identifying itself"""
 
@@ -243,30 +1125,302 @@ class Symbol(object):
         """Serialize to string"""
         return self.__name
 
-def make_symbol(name, symbol_table={}):
-    """Using default argument to initialize a global symbol table
-    the symbol table is for symbol only!
+    def __reduce__(self):
+        """Unpickle through the symbol table, so eq? and #t still hold"""
+        return (make_symbol, (self.__name,))
+
+# symbols of code not run by an Interpreter
+SYMBOLS = {}
+
+class State(threading.local):
+    """Symbol table, output port, profiler and budget of the Interpreter
+    running in a thread
     """
 
+    symbols = SYMBOLS
+    out = None
+    profiler = None
+    budget = None
+
+_state = State()
+
+def make_symbol(name, symbol_table=None):
+    """Intern in the symbol table of the running Interpreter, or the global
+    one; the symbol table is for symbol only!
+    """
+    if symbol_table is None:
+        symbol_table = _state.symbols
     if not name in symbol_table:
         symbol_table[name] = Symbol(name)
     return symbol_table[name]
 
+TRUE = make_symbol('#t')
+FALSE = make_symbol('#f')
+
 def make_boolean(is_true):
     """#t for true, #f for false"""
     if is_true:
-        return make_symbol('#t')
+        return TRUE
     else:
-        return make_symbol('#f')
+        return FALSE
+
+# used by define-memoized whatever memoize is bound to
+MEMOIZE = PrimitiveFunction(memoize)
+# used by cons-stream whatever cons is bound to
+CONS = PrimitiveFunction(cons, binary_cons, 2)
+
+# Profiler
+
+class Profiler(object):
+    """Call counts, inclusive and self time per named procedure
+
+    Time of a frame left by a tail call ends at the tail call, the called
+    procedure gets a frame of its own in the same position of the stack.
+    """
+
+    def __init__(self, clock=default_timer):
+        """Initialize with clock function"""
+        self.clock = clock
+        # name -> [calls, inclusive time, self time]
+        self.stats = {}
+        # open frames: [name, start, time spent in callees, call path node]
+        self.stack = []
+        # activations of each name on the stack, recursion is counted
+        # once in inclusive time
+        self.active = {}
+        # call paths form a tree of (parent node, name), with self time
+        self.nodes = {}
+        self.node_names = []
+        self.node_parents = []
+        self.node_times = []
+
+    def enter(self, name):
+        """Open a frame for procedure name"""
+        parent = self.stack[-1][3] if self.stack else -1
+        node = self.nodes.get((parent, name))
+        if node is None:
+            node = self.nodes[(parent, name)] = len(self.node_names)
+            self.node_names.append(name)
+            self.node_parents.append(parent)
+            self.node_times.append(0.0)
+        self.active[name] = self.active.get(name, 0) + 1
+        self.stack.append([name, self.clock(), 0.0, node])
+
+    def leave(self):
+        """Close the innermost frame"""
+        name, start, children, node = self.stack.pop()
+        elapsed = self.clock() - start
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = self.stats[name] = [0, 0.0, 0.0]
+        entry[0] += 1
+        self.active[name] -= 1
+        if not self.active[name]:
+            entry[1] += elapsed
+        entry[2] += elapsed - children
+        self.node_times[node] += elapsed - children
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def call(self, proc, args):
+        """Apply primitive inside a frame"""
+        self.enter(procedure_name(proc))
+        try:
+            return proc.apply(args)
+        finally:
+            self.leave()
+
+    def report(self, out=None, limit=None):
+        """Write table sorted by self time"""
+        out = out or sys.stdout
+        rows = sorted(self.stats.items(), key=lambda i: -i[1][2])[:limit]
+        out.write('%-30s %10s %12s %12s\n'
+            % ('procedure', 'calls', 'inclusive', 'self'))
+        for name, (calls, inclusive, own) in rows:
+            out.write('%-30s %10d %12.6f %12.6f\n'
+                % (name, calls, inclusive, own))
+
+    def write_collapsed(self, out):
+        """Write stacks in collapsed format (flamegraph.pl input),
+        weighted by self time in microseconds
+        """
+        for node, own in enumerate(self.node_times):
+            weight = int(own * 1e6)
+            if weight <= 0:
+                continue
+            path = []
+            while node >= 0:
+                path.append(self.node_names[node])
+                node = self.node_parents[node]
+            out.write('%s %d\n' % (';'.join(reversed(path)), weight))
+
+def procedure_name(proc):
+    """Name used by the profiler"""
+    if isinstance(proc, Lambda):
+        return proc.get_name() or 'lambda'
+    return proc.name or proc.get_func().__name__
+
+def name_procedure(proc, name):
+    """Give an anonymous procedure the name it is defined with"""
+    if isinstance(proc, MemoizedProcedure):
+        if proc.name is None:
+            proc.name = name + ' (memoized)'
+        name_procedure(proc.proc, name)
+    elif isinstance(proc, PrimitiveFunction):
+        if proc.name is None:
+            proc.name = name
+    elif isinstance(proc, Lambda):
+        if proc.get_name() is None:
+            proc.set_name(name)
+    return proc
+
+# profilers in use by any thread, evaluators only look for the profiler
+# of their thread when there is one
+_profilers = 0
+_profilers_lock = threading.Lock()
+
+def current_profiler():
+    """Profiler of this thread, None when not profiling"""
+    return _state.profiler if _profilers else None
+
+@contextmanager
+def profiling(profiler):
+    """Profile evaluation in this thread inside the with block"""
+    global _profilers
+    if profiler is None:
+        yield profiler
+        return
+    previous = _state.profiler
+    _state.profiler = profiler
+    with _profilers_lock:
+        _profilers += 1
+    try:
+        yield profiler
+    finally:
+        with _profilers_lock:
+            _profilers -= 1
+        _state.profiler = previous
+
+# Budget
+
+class BudgetExceeded(Exception):
+    """Evaluation went over one of the limits of its Budget"""
+
+class OutOfFuel(BudgetExceeded):
+    """More evaluation steps and primitive calls than allowed"""
+
+class DeadlineExceeded(BudgetExceeded):
+    """Evaluation ran past its wall clock deadline"""
+
+class AllocationLimitExceeded(BudgetExceeded):
+    """More cons cells allocated than allowed"""
+
+class Budget(object):
+    """Limits on evaluation, and what was spent against them
+
+    Every evaluation step and primitive call costs one unit of fuel. The
+    deadline is checked every 1024 units. Pairs made by cons and list
+    count as allocations. Analyzed code charges procedure applications,
+    plus primitive calls when it was analyzed under a budget.
+    """
+
+    def __init__(self, fuel=None, seconds=None, pairs=None,
+            clock=default_timer):
+        """Initialize with limits, None for no limit, and clock function"""
+        self.max_fuel = fuel
+        self.seconds = seconds
+        self.max_pairs = pairs
+        self.clock = clock
+        self.fuel = 0
+        self.steps = 0
+        self.calls = 0
+        self.pairs = 0
+        self.deadline = None
+        self.started = None
+        self.elapsed = 0.0
+
+    def start(self):
+        """Start the clock"""
+        self.started = self.clock()
+        if self.seconds is not None:
+            self.deadline = self.started + self.seconds
+
+    def stop(self):
+        """Stop the clock"""
+        self.elapsed += self.clock() - self.started
+        self.deadline = None
+
+    def step(self):
+        """Charge an evaluation step"""
+        self.steps += 1
+        self.spend()
+
+    def call(self):
+        """Charge a primitive call"""
+        self.calls += 1
+        self.spend()
+
+    def spend(self):
+        """Take one unit of fuel"""
+        self.fuel += 1
+        if self.max_fuel is not None and self.fuel > self.max_fuel:
+            raise OutOfFuel('Out of fuel : %d' % self.max_fuel)
+        if (self.deadline is not None and not self.fuel & 1023
+                and self.clock() > self.deadline):
+            raise DeadlineExceeded('Deadline exceeded : %gs' % self.seconds)
+
+    def allocate(self, pairs):
+        """Charge allocation of pairs"""
+        self.pairs += pairs
+        if self.max_pairs is not None and self.pairs > self.max_pairs:
+            raise AllocationLimitExceeded(
+                'Allocation limit exceeded : %d pairs' % self.max_pairs)
+
+    def get_stats(self):
+        """Get what was spent"""
+        return {'fuel': self.fuel, 'steps': self.steps, 'calls': self.calls,
+                'pairs': self.pairs, 'seconds': self.elapsed}
+
+# budgets in use by any thread, evaluators only look for the budget of
+# their thread when there is one
+_budgets = 0
+_budgets_lock = threading.Lock()
+
+def current_budget():
+    """Budget of this thread, None when not budgeting"""
+    return _state.budget if _budgets else None
+
+@contextmanager
+def budgeting(budget):
+    """Charge evaluation in this thread inside the with block to budget"""
+    global _budgets
+    if budget is None:
+        yield budget
+        return
+    previous = _state.budget
+    _state.budget = budget
+    with _budgets_lock:
+        _budgets += 1
+    budget.start()
+    try:
+        yield budget
+    finally:
+        budget.stop()
+        with _budgets_lock:
+            _budgets -= 1
+        _state.budget = previous
 
 # Metacircular evaluator
 
 def eval_primitive(exp):
-    """Evaluate primitive object"""
-    if is_number(exp):
-        return eval(exp)
+    """Convert number or string token to its value"""
+    if INTEGER_PATTERN.match(exp):
+        return int(exp)
+    elif is_number(exp):
+        return float(exp)
     elif is_string(exp):
-        return exp.strip('"');
+        return String(ESCAPE_PATTERN.sub(
+            lambda m: ESCAPES.get(m.group(1), m.group(1)), exp[1:-1]))
 
 def eval_variable(exp, env):
     """Look up variable in environment chain"""
@@ -281,10 +1435,10 @@ def eval_definition(exp, env):
     """Define variable in current environment
     behave like set! (not correct)
     """
-    if is_variable(exp[1]):
-        env[exp[1]] = evaluate(exp[2], env)
+    if is_identifier(exp[1]):
+        env[exp[1]] = name_procedure(evaluate(exp[2], env), exp[1])
     else:
-        env[exp[1][0]] = Lambda(exp[1][1:], exp[2:], env)
+        env[exp[1][0]] = Lambda(exp[1][1:], exp[2:], env, exp[1][0])
 
 def eval_set(exp, env, eval_env):
     """Modify binding"""
@@ -300,6 +1454,10 @@ def eval_application(exp, env):
     # apply function (could be lambda or primitive)
     return args[0].apply(args[1:])
 
+def eval_delay(exp, env):
+    """Promise to evaluate expression later"""
+    return Promise(evaluate, exp[1], env)
+
 def eval_quote(exp):
     """Evaluate quotation
     and convert python list to nested pairs
@@ -315,6 +1473,15 @@ def eval_sequence(exp, env):
 
 # Expand derived structure
 
+def cons_stream_to_cons(exp):
+    """Syntax transformation from cons-stream to cons of a delay"""
+    return [CONS, exp[1], ['delay', exp[2]]]
+
+def memoized_definition_to_definition(exp):
+    """Syntax transformation from define-memoized to define of memoize"""
+    return ['define', exp[1][0],
+        [MEMOIZE, ['lambda', exp[1][1:]] + exp[2:]]]
+
 def let_to_lambda(exp):
     """Syntax transformation from let to lambda"""
     bindings = zip(*exp[1])
@@ -325,98 +1492,2615 @@ def let_to_lambda(exp):
     f.extend(args)
     return f
 
-def evaluate(exp, env):
-    """Evaluate parsed Scheme list in an environment"""
-    # use while to prevent stack overflow
-    while True:
-        if is_primitive(exp):
-            return eval_primitive(exp)
-        elif is_variable(exp):
-            return eval_variable(exp, env)
-        elif is_quote(exp):
-            return eval_quote(exp)
-        elif is_lambda(exp):
-            return Lambda.make(exp, env)
-        elif is_definition(exp):
-            return eval_definition(exp, env)
-        elif is_set(exp):
-            return eval_set(exp, env, env)
-        elif is_sequence(exp):
-            eval_sequence(exp[1:-1], env)
-            exp = exp[-1]
-        elif is_if(exp):
-            condition = evaluate(exp[1], env)
-            # type 1 : (if cond exp1 exp2)
-            if len(exp) == 4:
-                if condition is make_boolean(True):
-                    exp = exp[2]
-                else:
-                    exp = exp[3]
-            elif len(exp) == 3:
-                if condition is make_boolean(True):
-                    exp = exp[2]
-                else:
-                    return None
+def cond_to_if(exp):
+    """Syntax transformation from cond to nested ifs"""
+    result = None
+    for clause in reversed(exp[1:]):
+        if clause[0] == 'else':
+            result = clause_to_exp(clause)
+        elif result is None:
+            result = ['if', clause[0], clause_to_exp(clause)]
+        else:
+            result = ['if', clause[0], clause_to_exp(clause), result]
+    return result
+
+class EllipsisMatch(list):
+    """Forms matched by a pattern followed by ..."""
+
+class SyntaxRules(object):
+    """Macro defined with syntax-rules
+
+    Not hygienic: names introduced by a template may capture or be
+    captured by names at the use site.
+    """
+
+    def __init__(self, literals, rules, name=None):
+        """Initialize with literal names and (pattern, template) pairs"""
+        self.literals = literals
+        self.rules = rules
+        self.name = name
+
+    def expand(self, exp):
+        """Expansion of a use of the macro"""
+        for pattern, template in self.rules:
+            bindings = {}
+            # the keyword position is ignored
+            if self.match(pattern[1:], exp[1:], bindings):
+                return fill_template(template, bindings)
+        raise Exception('No syntax rule matches : ' + to_string(exp))
+
+    def match(self, pattern, form, bindings):
+        """Match form against pattern, binding its variables"""
+        if is_identifier(pattern):
+            if pattern in self.literals:
+                return form == pattern
+            elif pattern != '_':
+                bindings[pattern] = form
+            return True
+        elif isinstance(pattern, list):
+            if not isinstance(form, list):
+                return False
+            if '...' in pattern:
+                i = pattern.index('...')
+                before = pattern[:i - 1]
+                after = pattern[i + 1:]
+                count = len(form) - len(before) - len(after)
+                if count < 0:
+                    return False
+                matches = []
+                for f in form[len(before):len(before) + count]:
+                    b = {}
+                    if not self.match(pattern[i - 1], f, b):
+                        return False
+                    matches.append(b)
+                for name in pattern_variables(pattern[i - 1], self.literals):
+                    bindings[name] = EllipsisMatch(b[name] for b in matches)
+                return (self.match(before, form[:len(before)], bindings)
+                    and self.match(after, form[len(form) - len(after):],
+                        bindings))
+            return len(pattern) == len(form) and all(
+                self.match(p, f, bindings) for p, f in zip(pattern, form))
+        return pattern == form
+
+def pattern_variables(pattern, literals):
+    """Names a syntax-rules pattern binds"""
+    if is_identifier(pattern):
+        if pattern in literals or pattern in ('_', '...'):
+            return []
+        return [pattern]
+    elif isinstance(pattern, list):
+        return [name for p in pattern
+            for name in pattern_variables(p, literals)]
+    return []
+
+def fill_template(template, bindings):
+    """Instantiate syntax-rules template"""
+    if is_identifier(template):
+        return bindings.get(template, template)
+    elif not isinstance(template, list):
+        return template
+    result = []
+    i = 0
+    while i < len(template):
+        t = template[i]
+        if i + 1 < len(template) and template[i + 1] == '...':
+            names = [name for name in pattern_variables(t, ())
+                if isinstance(bindings.get(name), EllipsisMatch)]
+            if not names:
+                raise Exception('No pattern variable before ... in : '
+                    + to_string(template))
+            for k in range(min(len(bindings[name]) for name in names)):
+                b = dict(bindings)
+                for name in names:
+                    b[name] = bindings[name][k]
+                result.append(fill_template(t, b))
+            i += 2
+        else:
+            result.append(fill_template(t, bindings))
+            i += 1
+    return result
+
+def make_syntax_rules(exp, name=None):
+    """Macro of a (syntax-rules (literal ...) (pattern template) ...) form"""
+    if not is_tagged_list(exp, 'syntax-rules'):
+        raise Exception('Unsupported macro transformer : ' + to_string(exp))
+    return SyntaxRules(exp[1], [(rule[0], rule[1]) for rule in exp[2:]],
+        name)
+
+class Environment(dict):
+    """Global environment, its macros are kept apart from the variables"""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize like a dict, without macros"""
+        dict.__init__(self, *args, **kwargs)
+        self.macros = {}
+
+    def __reduce__(self):
+        """Pickle the variables only, save_image writes the macros"""
+        return (Environment, (), None, None, self.iteritems())
+
+def get_macros(env):
+    """Macros defined in global environment, a plain dict keeps none
+    between calls
+    """
+    if isinstance(env, Environment):
+        return env.macros
+    return {}
+
+def expand(exp, macros=None):
+    """Rewrite derived forms and macro uses of parsed code into core forms
+
+    Run once on every form before it is evaluated, so the evaluators never
+    transform the same let or cond twice. define-syntax registers its
+    macro in macros and expands to nothing; a later form using it is
+    expanded at this stage, not at runtime.
+    """
+    if macros is None:
+        macros = {}
+    while True:
+        if not isinstance(exp, list) or not exp or is_quote(exp):
+            return exp
+        head = exp[0]
+        if is_identifier(head) and head in macros:
+            exp = macros[head].expand(exp)
+        elif is_let(exp):
+            exp = let_to_lambda(exp)
         elif is_cond(exp):
-            clauses = exp[1:]
-            for c in clauses:
-                if c[0] != 'else':
-                    cond = evaluate(c[0], env)
-                    if cond is make_boolean(True):
-                        exp = c[1]
+            exp = cond_to_if(exp)
+        elif is_memoized_definition(exp):
+            exp = memoized_definition_to_definition(exp)
+        elif is_cons_stream(exp):
+            exp = cons_stream_to_cons(exp)
+        else:
+            break
+    if is_tagged_list(exp, 'define-syntax'):
+        macros[exp[1]] = make_syntax_rules(exp[2], exp[1])
+        return None
+    elif is_lambda(exp):
+        return ['lambda', exp[1]] + expand_body(exp[2:], macros)
+    elif is_definition(exp) and not is_identifier(exp[1]):
+        return ['define', exp[1]] + expand_body(exp[2:], macros)
+    return [expand(e, macros) for e in exp]
+
+def expand_body(body, macros):
+    """Expand lambda body, splicing begins so internal definitions are at
+    its top
+    """
+    result = []
+    for exp in body:
+        exp = expand(exp, macros)
+        if is_sequence(exp):
+            result.extend(exp[1:])
+        else:
+            result.append(exp)
+    return result or [None]
+
+def evaluate(exp, env):
+    """Evaluate parsed Scheme list in an environment"""
+    profiler = _state.profiler if _profilers else None
+    budget = _state.budget if _budgets else None
+    # whether a profiler frame is open for the procedure being run
+    profiled = False
+    try:
+        # use while to prevent stack overflow
+        while True:
+            if budget is not None:
+                budget.step()
+            if is_self_evaluating(exp):
+                return exp
+            elif is_identifier(exp):
+                return eval_variable(exp, env)
+            elif is_quote(exp):
+                return eval_quote(exp)
+            elif is_lambda(exp):
+                return Lambda.make(exp, env)
+            elif is_definition(exp):
+                return eval_definition(exp, env)
+            elif is_set(exp):
+                return eval_set(exp, env, env)
+            elif is_sequence(exp):
+                eval_sequence(exp[1:-1], env)
+                exp = exp[-1]
+            elif is_if(exp):
+                condition = evaluate(exp[1], env)
+                # type 1 : (if cond exp1 exp2)
+                if len(exp) == 4:
+                    if condition is TRUE:
+                        exp = exp[2]
+                    else:
+                        exp = exp[3]
+                elif len(exp) == 3:
+                    if condition is TRUE:
+                        exp = exp[2]
+                    else:
+                        return None
+            elif is_cond(exp):
+                clauses = exp[1:]
+                for c in clauses:
+                    if c[0] != 'else':
+                        cond = evaluate(c[0], env)
+                        if cond is TRUE:
+                            exp = clause_to_exp(c)
+                            break
+                    else:
+                        exp = clause_to_exp(c)
                         break
                 else:
-                    exp = c[1]
-                    break
+                    return None
+            elif is_let(exp):
+                exp = let_to_lambda(exp)
+            elif is_memoized_definition(exp):
+                exp = memoized_definition_to_definition(exp)
+            elif is_delay(exp):
+                return eval_delay(exp, env)
+            elif is_cons_stream(exp):
+                exp = cons_stream_to_cons(exp)
+            # must be the last clause
+            elif is_application(exp):
+                args = [evaluate(arg, env) for arg in exp]
+                proc = args[0]
+                args = args[1:]
+                if isinstance(proc, PrimitiveFunction):
+                    if budget is not None:
+                        budget.call()
+                    if profiler is not None:
+                        return profiler.call(proc, args)
+                    return proc.apply(args)
+                elif isinstance(proc, CompiledLambda):
+                    return apply_procedure(proc, args)
+                elif isinstance(proc, Lambda):
+                    if profiler is None and budget is None:
+                        proc.calls += 1
+                        if proc.specialized is not None:
+                            return proc.specialized(*args)
+                        if proc.calls == HOT_CALLS:
+                            specialize(proc, args)
+                    if profiler is not None:
+                        # a tail call replaces the frame
+                        if profiled:
+                            profiler.leave()
+                        profiler.enter(procedure_name(proc))
+                        profiled = True
+                    new_env = dict(zip(proc.get_paras(), args))
+                    new_env['**parent**'] = proc.get_parent_env()
+                    env = new_env
+                    exp = proc.get_sequence()
             else:
-                return None
+                return
+    finally:
+        if profiled:
+            profiler.leave()
+
+# Explicit-control evaluator
+
+# continuation frames are tuples tagged with one of these
+CONTINUE_DEFINE, CONTINUE_SET, CONTINUE_SEQUENCE, CONTINUE_IF, \
+    CONTINUE_COND, CONTINUE_ARGS = range(6)
+
+def clause_to_exp(clause):
+    """Body of cond clause as one expression"""
+    if len(clause) == 2:
+        return clause[1]
+    return ['begin'] + clause[1:]
+
+def evaluate_explicit(exp, env):
+    """Evaluate parsed Scheme list keeping continuations on a list
+
+    Unlike evaluate, nested (non tail) evaluation does not use the Python
+    stack, so recursion depth is only bounded by memory.
+    """
+    result = [None]
+    machine = explicit_machine(exp, env, result)
+    # outside run_async, awaitables are simply waited for
+    try:
+        awaitable = next(machine)
+        while True:
+            awaitable = machine.send(wait_result(awaitable))
+    except StopIteration:
+        return result[0]
+
+def explicit_machine(exp, env, result):
+    """Generator running the explicit-control evaluator
+
+    It yields the awaitable of every asynchronous primitive applied and
+    resumes with the value sent back; the final value goes in result[0].
+    """
+    true = TRUE
+    budget = current_budget()
+    stack = []
+    while True:
+        if budget is not None:
+            budget.step()
+        # reduce exp to a value, or push a continuation and go deeper
+        if is_self_evaluating(exp):
+            value = exp
+        elif is_identifier(exp):
+            value = eval_variable(exp, env)
+        elif is_quote(exp):
+            value = eval_quote(exp)
+        elif is_lambda(exp):
+            value = Lambda.make(exp, env)
+        elif is_definition(exp):
+            if is_identifier(exp[1]):
+                stack.append((CONTINUE_DEFINE, exp[1], env))
+                exp = exp[2]
+                continue
+            value = eval_definition(exp, env)
+        elif is_set(exp):
+            stack.append((CONTINUE_SET, exp[1], env))
+            exp = exp[2]
+            continue
+        elif is_sequence(exp):
+            if len(exp) == 1:
+                value = None
+            else:
+                if len(exp) > 2:
+                    stack.append((CONTINUE_SEQUENCE, exp, 2, env))
+                exp = exp[1]
+                continue
+        elif is_if(exp):
+            stack.append((CONTINUE_IF, exp, env))
+            exp = exp[1]
+            continue
+        elif is_cond(exp):
+            clause = exp[1]
+            if clause[0] == 'else':
+                exp = clause_to_exp(clause)
+            else:
+                stack.append((CONTINUE_COND, exp, 1, env))
+                exp = clause[0]
+            continue
         elif is_let(exp):
             exp = let_to_lambda(exp)
+            continue
+        elif is_memoized_definition(exp):
+            exp = memoized_definition_to_definition(exp)
+            continue
+        elif is_delay(exp):
+            value = Promise(evaluate_explicit, exp[1], env)
+        elif is_cons_stream(exp):
+            exp = cons_stream_to_cons(exp)
+            continue
         # must be the last clause
         elif is_application(exp):
-            args = [evaluate(arg, env) for arg in exp]
-            proc = args[0]
-            args = args[1:]
-            if isinstance(proc, PrimitiveFunction):
+            stack.append((CONTINUE_ARGS, exp, [], env))
+            exp = exp[0]
+            continue
+        else:
+            value = None
+
+        # pass the value to continuations until one has more to evaluate
+        while stack:
+            frame = stack.pop()
+            tag = frame[0]
+            if tag == CONTINUE_ARGS:
+                exp, values, env = frame[1:]
+                values.append(value)
+                if len(values) < len(exp):
+                    stack.append(frame)
+                    exp = exp[len(values)]
+                    break
+                proc = values[0]
+                args = values[1:]
+                # a primitive may let go of its arguments, like the head of
+                # a stream, so no other reference is kept
+                value = values = frame = None
+                if isinstance(proc, PrimitiveFunction):
+                    if budget is not None:
+                        budget.call()
+                    if proc.__class__ is AsyncPrimitive:
+                        # suspend, the rest of the computation is on the
+                        # stack
+                        value = yield proc.start(args)
+                    else:
+                        value = proc.apply(args)
+                elif isinstance(proc, CompiledLambda):
+                    value = apply_procedure(proc, args)
+                elif isinstance(proc, Lambda):
+                    # tail call, nothing is pushed
+                    env = dict(zip(proc.get_paras(), args))
+                    env['**parent**'] = proc.get_parent_env()
+                    exp = proc.get_sequence()
+                    break
+                else:
+                    raise Exception('Not applicable : ' + str(proc))
+            elif tag == CONTINUE_SEQUENCE:
+                exp, i, env = frame[1:]
+                if i + 1 < len(exp):
+                    stack.append((CONTINUE_SEQUENCE, exp, i + 1, env))
+                exp = exp[i]
+                break
+            elif tag == CONTINUE_IF:
+                exp, env = frame[1:]
+                if value is true:
+                    exp = exp[2]
+                    break
+                elif len(exp) == 4:
+                    exp = exp[3]
+                    break
+                value = None
+            elif tag == CONTINUE_COND:
+                exp, i, env = frame[1:]
+                if value is true:
+                    exp = clause_to_exp(exp[i])
+                    break
+                elif i + 1 < len(exp):
+                    clause = exp[i + 1]
+                    if clause[0] == 'else':
+                        exp = clause_to_exp(clause)
+                    else:
+                        stack.append((CONTINUE_COND, exp, i + 1, env))
+                        exp = clause[0]
+                    break
+                value = None
+            elif tag == CONTINUE_DEFINE:
+                frame[2][frame[1]] = name_procedure(value, frame[1])
+                value = None
+            elif tag == CONTINUE_SET:
+                name, env = frame[1:]
+                while name not in env:
+                    env = env['**parent**']
+                env[name] = value
+                value = None
+        else:
+            result[0] = value
+            return
+
+# Syntactic analysis
+
+class Scope(object):
+    """Compile time frame: names of one lambda's parameters and locals,
+    and of the variables of enclosing lambdas it captures
+    """
+
+    def __init__(self, paras, parent=None, boxed=()):
+        """Initialize with parameter names, enclosing scope and the names
+        to keep in cells
+        """
+        self.names = list(paras)
+        self.nparams = len(self.names)
+        self.parent = parent
+        self.free = []
+        self.boxed = set(boxed)
+
+    def define(self, name):
+        """Reserve a slot for an internal definition"""
+        if name not in self.names:
+            self.names.append(name)
+        return self.names.index(name)
+
+    def lookup(self, name):
+        """Address (free, index) of variable, None for global variables
+
+        A variable of an enclosing lambda becomes a free variable of this
+        scope, and of every scope in between, when it is first looked up.
+        """
+        if name in self.names:
+            return False, self.names.index(name)
+        elif name in self.free:
+            return True, self.free.index(name)
+        elif self.parent is None or self.parent.lookup(name) is None:
+            return None
+        self.free.append(name)
+        return True, len(self.free) - 1
+
+    def is_boxed(self, name):
+        """Is the variable kept in a Cell shared by its closures?"""
+        scope = self
+        while name not in scope.names:
+            scope = scope.parent
+        return name in scope.boxed
+
+class Frame(object):
+    """Runtime frame: slot values indexed by lexical address, and those
+    captured by the closure being run
+    """
+
+    __slots__ = ('values', 'free', 'top')
+
+    def __init__(self, values, free, top):
+        """Initialize with values, captured values and global environment"""
+        self.values = values
+        self.free = free
+        self.top = top
+
+class Cell(object):
+    """Variable both captured by a closure and assigned"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        """Initialize with value"""
+        self.value = value
+
+class Unassigned(object):
+    """Marker for internal definitions not evaluated yet"""
+
+    def __str__(self):
+        """Serialize to string"""
+        return '*unassigned*'
+
+    def __reduce__(self):
+        """Unpickle as the module singleton"""
+        return 'UNASSIGNED'
+
+UNASSIGNED = Unassigned()
+
+class Code(object):
+    """Analyzed lambda body, shared by every closure of one lambda"""
+
+    __slots__ = ('execute', 'nparams', 'padding', 'boxed', 'name', 'paras',
+        'body', 'scope')
+
+    def __init__(self, execute, scope, name, paras, body):
+        """Initialize with analyzed body, its scope, definition name
+        and the source it was analyzed from
+        """
+        self.execute = execute
+        self.nparams = scope.nparams
+        self.padding = [UNASSIGNED] * (len(scope.names) - scope.nparams)
+        # slots holding cells, made afresh for every call
+        self.boxed = [i for i, slot in enumerate(scope.names)
+            if slot in scope.boxed]
+        self.name = name
+        self.paras = paras
+        self.body = body
+        self.scope = scope
+
+    def __reduce__(self):
+        """Closures cannot be pickled, analyze the source again instead"""
+        return (analyze_code,
+            (self.paras, self.body, self.scope.parent, self.name))
+
+class CompiledLambda(Lambda):
+    """Lambda function object whose body is already analyzed
+
+    It keeps only the variables of enclosing lambdas its body uses, not
+    their frames, so a closure does not hold on to unrelated bindings.
+    """
+
+    def __init__(self, paras, body, free, top, code):
+        """Initialize like Lambda, plus the analyzed body and the values,
+        or cells, of its free variables
+        """
+        Lambda.__init__(self, paras, body, top)
+        self.code = code
+        self.free = free
+        self.top = top
+
+    def get_name(self):
+        """Get name it was defined with, None if anonymous"""
+        return Lambda.get_name(self) or self.code.name
+
+class TailCall(object):
+    """Application left pending by a procedure body in tail position"""
+
+    __slots__ = ('proc', 'args')
+
+    def __init__(self, proc, args):
+        """Initialize with procedure and evaluated arguments"""
+        self.proc = proc
+        self.args = args
+
+def apply_procedure(proc, args):
+    """Apply any procedure object, running tail calls in a loop"""
+    profiler = _state.profiler if _profilers else None
+    budget = _state.budget if _budgets else None
+    # whether a profiler frame is open for the procedure being run
+    profiled = False
+    try:
+        while True:
+            if budget is not None:
+                budget.step()
+            if isinstance(proc, CompiledLambda):
+                code = proc.code
+                if len(args) != code.nparams:
+                    raise Exception('Wrong number of arguments : %d for %d'
+                        % (len(args), code.nparams))
+                if profiler is not None:
+                    # a tail call replaces the frame
+                    if profiled:
+                        profiler.leave()
+                    profiler.enter(procedure_name(proc))
+                    profiled = True
+                # the argument list is fresh, so it becomes the frame itself
+                if code.padding:
+                    args.extend(code.padding)
+                for i in code.boxed:
+                    args[i] = Cell(args[i])
+                result = code.execute(Frame(args, proc.free, proc.top))
+                if result.__class__ is not TailCall:
+                    return result
+                proc = result.proc
+                args = result.args
+            elif isinstance(proc, PrimitiveFunction):
+                if budget is not None:
+                    budget.call()
+                if profiler is not None:
+                    return profiler.call(proc, args)
                 return proc.apply(args)
             elif isinstance(proc, Lambda):
-                new_env = dict(zip(proc.get_paras(), args))
-                new_env['**parent**'] = proc.get_parent_env()
-                env = new_env
-                exp = proc.get_body()[:]
-                exp.insert(0, 'begin')
+                if profiler is None and budget is None:
+                    proc.calls += 1
+                    if proc.specialized is not None:
+                        return proc.specialized(*args)
+                    if proc.calls == HOT_CALLS:
+                        specialize(proc, args)
+                env = dict(zip(proc.get_paras(), args))
+                env['**parent**'] = proc.get_parent_env()
+                return evaluate(proc.get_sequence(), env)
+            else:
+                raise Exception('Not applicable : ' + str(proc))
+    finally:
+        if profiled:
+            profiler.leave()
+
+def scan_out_defines(body, scope):
+    """Reserve slots for internal definitions before analyzing the body"""
+    for exp in body:
+        if is_definition(exp) or is_memoized_definition(exp):
+            if is_identifier(exp[1]):
+                scope.define(exp[1])
+            else:
+                scope.define(exp[1][0])
+        elif is_sequence(exp):
+            scan_out_defines(exp[1:], scope)
+
+def analyze_self_evaluating(exp):
+    """Literals evaluate to themselves"""
+    return lambda env: exp
+
+def analyze_global(name, scope):
+    """Look up variable in the global environment (or its chain)"""
+    if scope is None:
+        def execute(env):
+            try:
+                return env[name]
+            except KeyError:
+                return eval_variable(name, env)
+    else:
+        def execute(env):
+            try:
+                return env.top[name]
+            except KeyError:
+                return eval_variable(name, env.top)
+    return execute
+
+def analyze_variable(exp, scope):
+    """Resolve variable to its slot at analysis time"""
+    address = scope.lookup(exp) if scope is not None else None
+    if address is None:
+        return analyze_global(exp, scope)
+    free, index = address
+    if scope.is_boxed(exp):
+        # may be an internal definition referenced before evaluated
+        if free:
+            def execute(env):
+                value = env.free[index].value
+                if value is UNASSIGNED:
+                    raise Exception('Unassigned variable : ' + exp)
+                return value
+        else:
+            def execute(env):
+                value = env.values[index].value
+                if value is UNASSIGNED:
+                    raise Exception('Unassigned variable : ' + exp)
+                return value
+    elif free:
+        execute = lambda env: env.free[index]
+    elif index >= scope.nparams:
+        # internal definition, may be referenced before evaluated
+        def execute(env):
+            value = env.values[index]
+            if value is UNASSIGNED:
+                raise Exception('Unassigned variable : ' + exp)
+            return value
+    else:
+        execute = lambda env: env.values[index]
+    return execute
+
+def analyze_capture(name, scope):
+    """Slot content a closure captures, the cell of a boxed variable"""
+    free, index = scope.lookup(name)
+    if free:
+        return lambda env: env.free[index]
+    return lambda env: env.values[index]
+
+def captured_names(exp, names=None, inside=False):
+    """Collect every name occurring inside a lambda nested in expression"""
+    if names is None:
+        names = set()
+    if is_identifier(exp):
+        if inside:
+            names.add(exp)
+    elif isinstance(exp, list) and not is_quote(exp):
+        inside = inside or (is_lambda(exp) or is_let(exp)
+            or is_memoized_definition(exp)
+            or is_definition(exp) and not is_identifier(exp[1]))
+        for e in exp:
+            captured_names(e, names, inside)
+    return names
+
+def analyze_quote(exp):
+    """Convert quoted list to pairs once"""
+    value = pylist_to_pairs(exp[1])
+    return lambda env: value
+
+def analyze_delay(exp, scope):
+    """Promise to run the analyzed expression later"""
+    aproc = analyze(exp[1], scope)
+    return lambda env: Promise(aproc, env)
+
+def analyze_code(paras, body, scope, name=None):
+    """Analyze lambda body once in a new scope"""
+    # variables bound in the body and captured by a closure are shared
+    # through cells, in case they are assigned
+    boxed = bound_names(body) & captured_names(body)
+    inner = Scope(paras, scope, boxed)
+    scan_out_defines(body, inner)
+    # internal definitions found during analysis still grow the scope,
+    # so the frame layout is only read afterwards
+    return Code(analyze_sequence(body, inner, True), inner, name, paras, body)
+
+def analyze_lambda(paras, body, scope, name=None):
+    """Analyze body once, capture its free variables at runtime"""
+    code = analyze_code(paras, body, scope, name)
+    if scope is None:
+        return lambda env: CompiledLambda(paras, body, (), env, code)
+    captures = [analyze_capture(n, scope) for n in code.scope.free]
+    def execute(env):
+        return CompiledLambda(paras, body, [c(env) for c in captures],
+            env.top, code)
+    return execute
+
+def analyze_assignment(name, vproc, scope):
+    """Store into lexical address or global environment"""
+    address = scope.lookup(name) if scope is not None else None
+    if address is None:
+        def execute(env):
+            value = vproc(env)
+            if scope is not None:
+                env = env.top
+            while name not in env:
+                env = env['**parent**']
+            env[name] = value
+        return execute
+    free, index = address
+    if scope.is_boxed(name):
+        if free:
+            def execute(env):
+                env.free[index].value = vproc(env)
+        else:
+            def execute(env):
+                env.values[index].value = vproc(env)
+    else:
+        # captured variables that are assigned are boxed, so this is local
+        def execute(env):
+            env.values[index] = vproc(env)
+    return execute
+
+def analyze_definition(exp, scope):
+    """Define variable in current frame, or in the global environment"""
+    if not is_identifier(exp[1]):
+        name = exp[1][0]
+        vproc = analyze_lambda(exp[1][1:], exp[2:], scope, name)
+    elif is_lambda(exp[2]):
+        name = exp[1]
+        vproc = analyze_lambda(exp[2][1], exp[2][2:], scope, name)
+    else:
+        name = exp[1]
+        vproc = analyze(exp[2], scope)
+    if scope is None:
+        def execute(env):
+            env[name] = name_procedure(vproc(env), name)
+        return execute
+    index = scope.define(name)
+    if name in scope.boxed:
+        def execute(env):
+            env.values[index].value = name_procedure(vproc(env), name)
+    else:
+        def execute(env):
+            env.values[index] = name_procedure(vproc(env), name)
+    return execute
+
+def analyze_set(exp, scope):
+    """Modify binding"""
+    return analyze_assignment(exp[1], analyze(exp[2], scope), scope)
+
+def analyze_sequence(exps, scope, tail=False):
+    """Chain analyzed expressions, only the last one is in tail position"""
+    procs = [analyze(e, scope) for e in exps[:-1]]
+    if exps:
+        procs.append(analyze(exps[-1], scope, tail))
+    if not procs:
+        return lambda env: None
+    elif len(procs) == 1:
+        return procs[0]
+    first = procs[:-1]
+    last = procs[-1]
+    def execute(env):
+        for p in first:
+            p(env)
+        return last(env)
+    return execute
+
+def analyze_if(exp, scope, tail=False):
+    """Analyze (if cond exp1 exp2) and (if cond exp1)"""
+    true = TRUE
+    pproc = analyze(exp[1], scope)
+    cproc = analyze(exp[2], scope, tail)
+    if len(exp) == 4:
+        aproc = analyze(exp[3], scope, tail)
+    else:
+        aproc = lambda env: None
+    def execute(env):
+        if pproc(env) is true:
+            return cproc(env)
+        return aproc(env)
+    return execute
+
+def analyze_cond(exp, scope, tail=False):
+    """Analyze clauses into (predicate, body) pairs, else has no predicate"""
+    true = TRUE
+    clauses = []
+    for c in exp[1:]:
+        if c[0] != 'else':
+            clauses.append((analyze(c[0], scope),
+                analyze_sequence(c[1:], scope, tail)))
+        else:
+            clauses.append((None, analyze_sequence(c[1:], scope, tail)))
+            break
+    def execute(env):
+        for pproc, bproc in clauses:
+            if pproc is None or pproc(env) is true:
+                return bproc(env)
+    return execute
+
+def analyze_application(exp, scope, tail=False):
+    """Evaluate operator and operands, apply or defer in tail position"""
+    fproc = analyze(exp[0], scope)
+    aprocs = [analyze(e, scope) for e in exp[1:]]
+    # one and two operands are common enough to skip the argument list
+    # when the operator turns out to have a fast primitive version, code
+    # analyzed for profiling or under a budget keeps primitive calls
+    # visible instead
+    fast = current_profiler() is None and current_budget() is None
+    if fast and len(aprocs) == 1:
+        aproc = aprocs[0]
+        def execute(env):
+            proc = fproc(env)
+            x = aproc(env)
+            if proc.__class__ is PrimitiveFunction and proc.arity == 1:
+                return proc.fast(x)
+            elif tail and isinstance(proc, Lambda):
+                return TailCall(proc, [x])
+            args = [x]
+            # a primitive may let go of its arguments, like the head of a
+            # stream, so no other reference is kept
+            x = None
+            return apply_procedure(proc, args)
+    elif fast and len(aprocs) == 2:
+        aproc1, aproc2 = aprocs
+        def execute(env):
+            proc = fproc(env)
+            x = aproc1(env)
+            y = aproc2(env)
+            if proc.__class__ is PrimitiveFunction and proc.arity == 2:
+                return proc.fast(x, y)
+            elif tail and isinstance(proc, Lambda):
+                return TailCall(proc, [x, y])
+            args = [x, y]
+            x = y = None
+            return apply_procedure(proc, args)
+    else:
+        def execute(env):
+            proc = fproc(env)
+            args = [a(env) for a in aprocs]
+            if tail and isinstance(proc, Lambda):
+                return TailCall(proc, args)
+            return apply_procedure(proc, args)
+    return execute
+
+def analyze(exp, scope=None, tail=False):
+    """Transform parsed Scheme list into a closure taking an environment
+
+    Outside of any lambda (scope is None) the closure expects the global
+    environment dict, inside it expects a Frame.
+    """
+    if is_self_evaluating(exp):
+        return analyze_self_evaluating(exp)
+    elif is_identifier(exp):
+        return analyze_variable(exp, scope)
+    elif is_quote(exp):
+        return analyze_quote(exp)
+    elif is_lambda(exp):
+        return analyze_lambda(exp[1], exp[2:], scope)
+    elif is_definition(exp):
+        return analyze_definition(exp, scope)
+    elif is_set(exp):
+        return analyze_set(exp, scope)
+    elif is_sequence(exp):
+        return analyze_sequence(exp[1:], scope, tail)
+    elif is_if(exp):
+        return analyze_if(exp, scope, tail)
+    elif is_cond(exp):
+        return analyze_cond(exp, scope, tail)
+    elif is_let(exp):
+        return analyze(let_to_lambda(exp), scope, tail)
+    elif is_memoized_definition(exp):
+        return analyze(memoized_definition_to_definition(exp), scope)
+    elif is_delay(exp):
+        return analyze_delay(exp, scope)
+    elif is_cons_stream(exp):
+        return analyze(cons_stream_to_cons(exp), scope, tail)
+    # must be the last clause
+    elif is_application(exp):
+        return analyze_application(exp, scope, tail)
+    else:
+        return lambda env: None
+
+# Optimizer
+
+# primitives without side effects, calls on literal arguments are folded
+PURE_PRIMITIVES = (add, sub, mul, div, lt, gt, le, ge, eq)
+
+def bound_names(exp, names=None):
+    """Collect every name bound or assigned anywhere in expression"""
+    if names is None:
+        names = set()
+    if not isinstance(exp, list) or is_quote(exp):
+        return names
+    if is_lambda(exp):
+        names.update(p for p in exp[1] if is_identifier(p))
+    elif is_definition(exp) or is_memoized_definition(exp) or is_set(exp):
+        if is_identifier(exp[1]):
+            names.add(exp[1])
+        elif isinstance(exp[1], list):
+            names.update(p for p in exp[1] if is_identifier(p))
+    elif is_let(exp):
+        names.update(b[0] for b in exp[1] if is_identifier(b[0]))
+    for e in exp:
+        bound_names(e, names)
+    return names
+
+def is_constant(exp):
+    """Is the value known before running?"""
+    return is_self_evaluating(exp) or exp is None
+
+def is_number_literal(exp):
+    """Are you a literal number?"""
+    return isinstance(exp, (int, long, float))
+
+def fold_application(exp, env):
+    """Compute pure primitive call on literal numbers now"""
+    proc = env.get(exp[0])
+    if not (isinstance(proc, PrimitiveFunction)
+            and proc.get_func() in PURE_PRIMITIVES):
+        return exp
+    if not all(is_number_literal(arg) for arg in exp[1:]):
+        return exp
+    try:
+        return proc.apply(exp[1:])
+    except Exception:
+        # leave the error to runtime
+        return exp
+
+def optimize_if(exp):
+    """Keep only the branch chosen by a constant test"""
+    if not is_constant(exp[1]):
+        return exp
+    if exp[1] is TRUE:
+        return exp[2]
+    elif len(exp) == 4:
+        return exp[3]
+    return None
+
+def optimize_cond(exp):
+    """Drop clauses with constant false tests, stop at a constant true one"""
+    clauses = []
+    for c in exp[1:]:
+        if c[0] == 'else' or c[0] is TRUE:
+            if not clauses:
+                return clause_to_exp(c)
+            clauses.append(['else'] + c[1:])
+            break
+        elif not is_constant(c[0]):
+            clauses.append(c)
+    if not clauses:
+        return None
+    return ['cond'] + clauses
+
+def optimize_exp(exp, env, shadowed):
+    """Rewrite expression bottom up"""
+    if not isinstance(exp, list) or len(exp) == 0:
+        return exp
+    elif is_quote(exp):
+        # build the quoted structure once, it is a constant from now on
+        return pylist_to_pairs(exp[1])
+    elif is_lambda(exp):
+        return exp[:2] + [optimize_exp(e, env, shadowed) for e in exp[2:]]
+    elif is_definition(exp) or is_memoized_definition(exp):
+        return exp[:2] + [optimize_exp(e, env, shadowed) for e in exp[2:]]
+    elif is_set(exp):
+        return exp[:2] + [optimize_exp(exp[2], env, shadowed)]
+    elif is_let(exp):
+        bindings = [[b[0], optimize_exp(b[1], env, shadowed)] for b in exp[1]]
+        return ['let', bindings] + \
+            [optimize_exp(e, env, shadowed) for e in exp[2:]]
+    elif is_cond(exp):
+        clauses = [[optimize_exp(e, env, shadowed) for e in c]
+            if c[0] != 'else' else
+            ['else'] + [optimize_exp(e, env, shadowed) for e in c[1:]]
+            for c in exp[1:]]
+        return optimize_cond(['cond'] + clauses)
+    exp = [optimize_exp(e, env, shadowed) for e in exp]
+    if is_sequence(exp):
+        return exp
+    elif is_if(exp):
+        return optimize_if(exp)
+    elif is_identifier(exp[0]) and exp[0] not in shadowed:
+        return fold_application(exp, env)
+    return exp
+
+def format_ast(exp):
+    """Show parsed (and optimized) code in Scheme syntax"""
+    if isinstance(exp, list):
+        return '(' + ' '.join(format_ast(e) for e in exp) + ')'
+    elif isinstance(exp, String):
+        return write_atom(exp)
+    elif isinstance(exp, (Pair, EmptyList)) or \
+            (isinstance(exp, Symbol) and exp is not TRUE
+             and exp is not FALSE):
+        return "'" + to_string(exp, write_atom)
+    elif exp is None:
+        return '#!unspecific'
+    return str(exp)
+
+def optimize(exp, env=None, debug=False):
+    """Hoist quoted data, fold pure arithmetic and prune constant branches
+
+    A call is folded only if its operator is bound to a pure primitive in
+    env (the base environment by default) and is not rebound anywhere in
+    exp, so primitives are assumed not to be redefined later.
+    """
+    if env is None:
+        env = make_base()
+    exp = optimize_exp(exp, env, bound_names(exp))
+    if debug:
+        sys.stderr.write(format_ast(exp) + '\n')
+    return exp
+
+# Python backend
+
+# calls of these base primitives with this many arguments become Python
+# expressions, as long as the program binds no such name
+INLINE_OPERATORS = {
+    '+': (2, '(%s + %s)'),
+    '-': (2, '(%s - %s)'),
+    '*': (2, '(%s * %s)'),
+    '/': (2, '(%s / %s)'),
+    'car': (1, '%s.car'),
+    'cdr': (1, '%s.cdr'),
+    'cons': (2, 'Pair(%s, %s)'),
+}
+# the same for predicates, they give a Python condition
+INLINE_PREDICATES = {
+    '<': (2, '%s < %s'),
+    '>': (2, '%s > %s'),
+    '<=': (2, '%s <= %s'),
+    '>=': (2, '%s >= %s'),
+    '=': (2, '%s == %s'),
+    'eq?': (2, '%s is %s'),
+    'null?': (1, '%s is NIL'),
+    'pair?': (1, 'isinstance(%s, Pair)'),
+}
+
+def make_procedure(func, nparams, name=None, trampolined=False):
+    """Procedure value of a compiled Python function, trampolined when
+    func may return TailCalls
+    """
+    if trampolined:
+        fast = lambda *args: finish_call(func(*args))
+        proc = PrimitiveFunction(lambda args: fast(*args), fast, nparams)
+        # run in place by finish_call, without a Python frame per call
+        proc.function = func
+    else:
+        proc = PrimitiveFunction(lambda args: func(*args), func, nparams)
+    proc.name = name
+    return proc
+
+def finish_call(value):
+    """Run the tail calls compiled code returns until a value comes out"""
+    while value.__class__ is TailCall:
+        proc = value.proc
+        if proc.__class__ is FunctionType:
+            value = proc(*value.args)
+        elif (proc.__class__ is PrimitiveFunction
+                and getattr(proc, 'function', None) is not None
+                and proc.arity == len(value.args)):
+            value = proc.function(*value.args)
+        else:
+            return apply_procedure(proc, value.args)
+    return value
+
+def call_procedure(proc, *args):
+    """Apply procedure value from compiled code"""
+    if proc.__class__ is PrimitiveFunction and proc.arity == len(args):
+        return proc.fast(*args)
+    return apply_procedure(proc, list(args))
+
+def assigned_names(exp, names=None):
+    """Collect every name changed by set! anywhere in expression"""
+    if names is None:
+        names = set()
+    if not isinstance(exp, list) or is_quote(exp):
+        return names
+    if is_set(exp):
+        names.add(exp[1])
+    for e in exp:
+        assigned_names(e, names)
+    return names
+
+def makes_closure(exp):
+    """Does expression create procedures or promises closing over its
+    variables?
+    """
+    if not isinstance(exp, list) or is_quote(exp):
+        return False
+    if is_immediate_lambda(exp):
+        return any(makes_closure(e) for e in exp[0][2:] + exp[1:])
+    if (is_lambda(exp) or is_delay(exp) or is_cons_stream(exp)
+            or is_memoized_definition(exp)
+            or is_definition(exp) and not is_identifier(exp[1])):
+        return True
+    return any(makes_closure(e) for e in exp)
+
+def is_immediate_lambda(exp):
+    """Is exp a let expanded to the application of a lambda?"""
+    return (is_application(exp) and is_lambda(exp[0])
+        and isinstance(exp[0][1], list)
+        and len(exp[0][1]) == len(exp) - 1)
+
+def lambda_to_let(exp):
+    """Syntax transformation from application of lambda to let"""
+    return ['let', [[p, a] for p, a in zip(exp[0][1], exp[1:])]] + exp[0][2:]
+
+def function_parts(exp):
+    """(name, parameters, body) of a definition of a procedure, None for
+    other definitions
+    """
+    if not is_identifier(exp[1]):
+        return exp[1][0], exp[1][1:], exp[2:]
+    elif is_lambda(exp[2]):
+        return exp[1], exp[2][1], exp[2][2:]
+    return None
+
+def python_literal(exp):
+    """Python source of quoted parsed data"""
+    if isinstance(exp, list):
+        return '[%s]' % ', '.join(python_literal(e) for e in exp)
+    elif exp is TRUE:
+        return 'TRUE'
+    elif exp is FALSE:
+        return 'FALSE'
+    elif isinstance(exp, String):
+        return 'String(%r)' % str(exp)
+    return repr(exp)
+
+def atom(source):
+    """Parenthesize number, so an attribute can follow"""
+    if source[0].isdigit() or source[0] in '-.':
+        return '(%s)' % source
+    return source
+
+class Binding(object):
+    """Python variable a Scheme name is compiled to"""
+
+    def __init__(self, pyname, boxed=False, arity=None, static=False,
+            clean=True):
+        """Initialize with Python name and how the variable is used"""
+        self.pyname = pyname
+        # changed by set!, kept in a one element list closures share
+        self.boxed = boxed
+        # number of parameters when bound to a def of the module
+        self.arity = arity
+        # top level function, its procedure value is in env
+        self.static = static
+        # the function never returns a TailCall
+        self.clean = clean
+
+class TailLoop(object):
+    """Function whose tail calls to itself become a loop"""
+
+    def __init__(self, binding, params):
+        """Initialize with binding of the function and its parameters"""
+        self.binding = binding
+        self.params = params
+        self.used = False
+
+class Transpiler(object):
+    """Compile parsed program to the source of a Python module
+
+    Code is made of (indent level, line) pairs. Procedure definitions
+    become Python functions, called directly where the name is known;
+    tail calls of a function to itself become a loop unless the function
+    makes closures. Other tail calls to procedures of the program return
+    a TailCall that finish_call runs, so mutually recursive procedures do
+    not grow the Python stack. Top level functions defined once, before
+    any use and not over a base name, are module functions; other globals
+    live in the module's env.
+    """
+
+    def __init__(self, program):
+        """Initialize with the whole program"""
+        self.bound = bound_names(program)
+        self.assigned = assigned_names(program)
+        self.count = 0
+        self.constants = []
+        self.globals = {}
+        # Python names of the functions that may return TailCalls
+        self.unclean = set()
+        # per function being written, whether it returned a TailCall
+        self.trampolines = []
+
+    def fresh(self, name):
+        """New Python name for Scheme name"""
+        self.count += 1
+        name = re.sub(r'\W', '_', name)
+        if name[0].isdigit():
+            name = '_' + name
+        return '%s_%d' % (name, self.count)
+
+    def constant(self, source):
+        """Name of module constant built once by source"""
+        name = self.fresh('c')
+        self.constants.append('%s = %s' % (name, source))
+        return name
+
+    def lookup(self, name, scope):
+        """Binding of name, None for globals in env"""
+        for frame in reversed(scope):
+            if name in frame:
+                return frame[name]
+        return self.globals.get(name)
+
+    def module(self, forms):
+        """Source of module running top level forms"""
+        functions = {}
+        others = set()
+        used = set()
+        # base names and names used before their def stay in env, a call
+        # may run before the def does
+        early = set(make_base())
+        for exp in forms:
+            parts = is_definition(exp) and function_parts(exp)
+            if parts:
+                functions.setdefault(parts[0], []).append(parts)
+                if parts[0] in used:
+                    early.add(parts[0])
+            elif is_definition(exp) or is_memoized_definition(exp):
+                others.add(exp[1] if is_identifier(exp[1]) else exp[1][0])
+            captured_names(exp, used, True)
+        for name, definitions in functions.items():
+            if (len(definitions) == 1 and name not in others
+                    and name not in early and name not in self.assigned):
+                paras, body = definitions[0][1:]
+                self.globals[name] = Binding(self.fresh(name),
+                    arity=len(paras), static=True,
+                    clean=not self.leaves_tail_calls(name, paras, body))
+        lines = []
+        for exp in forms:
+            if is_definition(exp) or is_memoized_definition(exp) \
+                    or is_set(exp):
+                self.statement(exp, [], lines, 0)
+                lines.append((0, 'result = None'))
+            else:
+                lines.append((0, 'result = %s'
+                    % self.expression(exp, [], lines, 0)))
+        header = [
+            '"""Compiled from Scheme by pyscm %s, do not edit"""' % __version__,
+            '',
+            'from pyscm import CONS, FALSE, MEMOIZE, NIL, Pair, Promise, '
+                'String, TRUE, \\',
+            '    TailCall, call_procedure, finish_call, make_base, '
+                'make_procedure, \\',
+            '    pylist_to_pairs',
+            '',
+            'env = make_base()',
+            '',
+        ]
+        if self.constants:
+            header.extend(self.constants + [''])
+        return '\n'.join(header + [
+            '    ' * level + line for level, line in lines]) + '\n'
+
+    def expression(self, exp, scope, lines, level):
+        """Python expression of exp, defs it needs go to lines first"""
+        if is_immediate_lambda(exp):
+            exp = lambda_to_let(exp)
+        if exp is None:
+            return 'None'
+        elif exp is TRUE:
+            return 'TRUE'
+        elif exp is FALSE:
+            return 'FALSE'
+        elif is_number_literal(exp):
+            return repr(exp)
+        elif isinstance(exp, String):
+            return self.constant('String(%r)' % str(exp))
+        elif exp is MEMOIZE:
+            return 'MEMOIZE'
+        elif exp is CONS:
+            return 'CONS'
+        elif is_self_evaluating(exp):
+            return self.literal(exp)
+        elif is_identifier(exp):
+            return self.reference(exp, scope)
+        elif is_quote(exp):
+            return self.constant('pylist_to_pairs(%s)'
+                % python_literal(exp[1]))
+        elif is_lambda(exp):
+            return self.procedure(self.function('lambda', exp[1], exp[2:],
+                scope, lines, level), len(exp[1]), None)
+        elif is_if(exp):
+            test = self.test(exp[1], scope, lines, level)
+            then = self.expression(exp[2], scope, lines, level)
+            if len(exp) == 4:
+                otherwise = self.expression(exp[3], scope, lines, level)
+            else:
+                otherwise = 'None'
+            return '(%s if %s else %s)' % (then, test, otherwise)
+        elif is_cond(exp):
+            branches = []
+            for clause in exp[1:]:
+                body = self.expression(clause_to_exp(clause), scope, lines,
+                    level)
+                if clause[0] == 'else':
+                    branches.append((None, body))
+                    break
+                branches.append((self.test(clause[0], scope, lines, level),
+                    body))
+            source = 'None'
+            for test, body in reversed(branches):
+                if test is None:
+                    source = body
+                else:
+                    source = '(%s if %s else %s)' % (body, test, source)
+            return source
+        elif is_sequence(exp) and len(exp) == 2:
+            return self.expression(exp[1], scope, lines, level)
+        elif is_let(exp):
+            bindings = exp[1]
+            inits = [self.expression(b[1], scope, lines, level)
+                for b in bindings]
+            return self.call(self.function('let', [b[0] for b in bindings],
+                exp[2:], scope, lines, level), inits)
+        elif is_memoized_definition(exp):
+            return self.expression(memoized_definition_to_definition(exp),
+                scope, lines, level)
+        elif is_cons_stream(exp):
+            return self.expression(cons_stream_to_cons(exp), scope, lines,
+                level)
+        elif is_delay(exp):
+            name = self.function('delay', [], exp[1:], scope, lines, level)
+            if name in self.unclean:
+                return 'Promise(finish_call, TailCall(%s, []))' % name
+            return 'Promise(%s)' % name
+        elif is_definition(exp) or is_set(exp) or is_sequence(exp):
+            # statements, run by a function called right away
+            name = self.fresh('block')
+            lines.append((level, 'def %s():' % name))
+            self.trampolines.append(False)
+            self.tail(exp, scope, lines, level + 1, None)
+            if self.trampolines.pop():
+                self.unclean.add(name)
+            return self.call(name, [])
+        elif is_application(exp):
+            return self.application(exp, scope, lines, level)
+        return 'None'
+
+    def literal(self, value):
+        """Python expression of constant the optimizer left in the code"""
+        raise Exception('Cannot compile constant : ' + to_string(value))
+
+    def reference(self, name, scope):
+        """Python expression of variable"""
+        binding = self.lookup(name, scope)
+        if binding is None or binding.static:
+            return self.global_reference(name)
+        elif binding.boxed:
+            return binding.pyname + '[0]'
+        elif binding.arity is not None:
+            return self.procedure(binding.pyname, binding.arity, name,
+                binding)
+        return binding.pyname
+
+    def procedure(self, pyname, nparams, name, binding=None):
+        """Python expression of the procedure value of a function"""
+        if (pyname in self.unclean if binding is None
+                else not binding.clean):
+            return 'make_procedure(%s, %d, %r, True)' % (pyname, nparams,
+                name)
+        return 'make_procedure(%s, %d, %r)' % (pyname, nparams, name)
+
+    def call(self, pyname, args, binding=None):
+        """Python expression of direct call to a function"""
+        source = '%s(%s)' % (pyname, ', '.join(args))
+        if (pyname in self.unclean if binding is None
+                else not binding.clean):
+            return 'finish_call(%s)' % source
+        return source
+
+    def global_reference(self, name):
+        """Python expression of global variable"""
+        return 'env[%r]' % name
+
+    def inlinable(self, name):
+        """Is name sure to be the base primitive of that name?"""
+        return name not in self.bound
+
+    def check_tail(self, exp, scope):
+        """Called with each expression whose value is returned"""
+
+    def inline(self, exp, table, scope, lines, level):
+        """Python source of primitive call from table, None if it is not
+        one
+        """
+        name = exp[0]
+        if (not is_identifier(name) or name not in table
+                or table[name][0] != len(exp) - 1 or not self.inlinable(name)):
+            return None
+        args = [self.expression(e, scope, lines, level) for e in exp[1:]]
+        if '%s.' in table[name][1]:
+            args = map(atom, args)
+        return table[name][1] % tuple(args)
+
+    def test(self, exp, scope, lines, level):
+        """Python condition true when exp is #t"""
+        if exp is TRUE:
+            return 'True'
+        elif is_application(exp):
+            source = self.inline(exp, INLINE_PREDICATES, scope, lines, level)
+            if source is not None:
+                return source
+        return '%s is TRUE' % self.expression(exp, scope, lines, level)
+
+    def application(self, exp, scope, lines, level):
+        """Python expression of procedure call"""
+        source = self.inline(exp, INLINE_OPERATORS, scope, lines, level)
+        if source is not None:
+            return source
+        source = self.inline(exp, INLINE_PREDICATES, scope, lines, level)
+        if source is not None:
+            return '(TRUE if %s else FALSE)' % source
+        binding = None
+        if is_identifier(exp[0]):
+            binding = self.lookup(exp[0], scope)
+        args = [self.expression(e, scope, lines, level) for e in exp[1:]]
+        if (binding is not None and not binding.boxed
+                and binding.arity == len(args)):
+            return self.call(binding.pyname, args, binding)
+        return 'call_procedure(%s)' % ', '.join(
+            [self.expression(exp[0], scope, lines, level)] + args)
+
+    def needs_trampoline(self, exp):
+        """Is exp in tail position a call the caller should run, as it
+        may go back to procedures of the program?
+        """
+        if (not is_application(exp) or is_quote(exp) or is_lambda(exp)
+                or is_delay(exp)):
+            return False
+        if is_identifier(exp[0]):
+            return exp[0] in self.bound
+        # constant operators are primitives
+        return isinstance(exp[0], list)
+
+    def tail_calls(self, exp):
+        """Applications whose value exp returns, as tail writes them"""
+        if is_immediate_lambda(exp):
+            exp = lambda_to_let(exp)
+        if is_if(exp):
+            return self.tail_calls(exp[2]) + (self.tail_calls(exp[3])
+                if len(exp) == 4 else [])
+        elif is_cond(exp):
+            return sum([self.tail_calls(clause_to_exp(clause))
+                for clause in exp[1:]], [])
+        elif is_sequence(exp):
+            return self.tail_calls(exp[-1]) if len(exp) > 1 else []
+        elif is_let(exp):
+            return self.tail_calls(exp[-1])
+        elif (is_cons_stream(exp) or is_definition(exp)
+                or is_memoized_definition(exp) or is_set(exp)):
+            return []
+        elif self.needs_trampoline(exp):
+            return [exp]
+        return []
+
+    def leaves_tail_calls(self, name, paras, body):
+        """May the function defined as name return TailCalls?
+
+        Its calls to itself become a loop when function can make one and
+        name is not bound again inside.
+        """
+        loops = (not assigned_names(body) & set(paras)
+            and not makes_closure(body)
+            and name not in bound_names(['lambda', paras] + body))
+        return any(not (loops and exp[0] == name
+            and len(exp) - 1 == len(paras))
+            for exp in self.tail_calls(body[-1]))
+
+    def function(self, name, paras, body, scope, lines, level, binding=None,
+            guard=None):
+        """Write def of Scheme procedure, return its Python name
+
+        guard gives the lines checking the parameters, by their Python
+        names, at the start of the function and of every loop; it is
+        called once the body is compiled.
+        """
+        pyname = binding.pyname if binding is not None else self.fresh(name)
+        assigned = assigned_names(body)
+        frame = {}
+        params = []
+        for p in paras:
+            frame[p] = Binding(self.fresh(p), p in assigned)
+            params.append(frame[p].pyname)
+        lines.append((level, 'def %s(%s):' % (pyname, ', '.join(params))))
+        for p in paras:
+            if frame[p].boxed:
+                lines.append((level + 1, '%s = [%s]' % (frame[p].pyname,
+                    frame[p].pyname)))
+        loop = None
+        if (binding is not None and not binding.boxed and not assigned
+                & set(paras) and not makes_closure(body)):
+            loop = TailLoop(binding, params)
+        code = []
+        self.trampolines.append(False)
+        self.body(body, scope + [frame], code, 0, loop)
+        if self.trampolines.pop():
+            if binding is not None and binding.clean:
+                raise Exception('Tail calls not expected in : ' + name)
+            self.unclean.add(pyname)
+        if guard is not None:
+            code[:0] = guard(params)
+        if loop is not None and loop.used:
+            lines.append((level + 1, 'while True:'))
+            level += 1
+        lines.extend((level + 1 + l, line) for l, line in code)
+        return pyname
+
+    def body(self, body, scope, lines, level, loop):
+        """Write lambda body, its internal definitions are local variables"""
+        frame = scope[-1]
+        assigned = assigned_names(body)
+        for exp in body:
+            if is_definition(exp) or is_memoized_definition(exp):
+                name = exp[1] if is_identifier(exp[1]) else exp[1][0]
+                if name in frame:
+                    continue
+                parts = is_definition(exp) and function_parts(exp)
+                boxed = name in assigned
+                if parts and not boxed:
+                    frame[name] = Binding(self.fresh(name), arity=len(
+                        parts[1]), clean=not self.leaves_tail_calls(*parts))
+                else:
+                    frame[name] = Binding(self.fresh(name), boxed)
+        for exp in body[:-1]:
+            self.statement(exp, scope, lines, level)
+        self.tail(body[-1], scope, lines, level, loop)
+
+    def definition(self, exp, scope, lines, level):
+        """Write define"""
+        if is_memoized_definition(exp):
+            exp = memoized_definition_to_definition(exp)
+        parts = function_parts(exp)
+        name = parts[0] if parts else exp[1]
+        if not scope:
+            binding = self.globals.get(name)
+            if binding is not None and binding.static:
+                self.function(name, parts[1], parts[2], scope, lines, level,
+                    binding)
+                lines.append((level, 'env[%r] = %s' % (name, self.procedure(
+                    binding.pyname, binding.arity, name, binding))))
+                return
+            lines.append((level, 'env[%r] = %s'
+                % (name, self.value(exp, parts, scope, lines, level))))
+            return
+        binding = scope[-1].get(name)
+        if binding is None:
+            raise Exception('Definition not at the start of a body : '
+                + name)
+        if binding.arity is not None and parts is not None:
+            self.function(name, parts[1], parts[2], scope, lines, level,
+                binding)
         else:
+            value = self.value(exp, parts, scope, lines, level)
+            if binding.boxed:
+                value = '[%s]' % value
+            lines.append((level, '%s = %s' % (binding.pyname, value)))
+
+    def value(self, exp, parts, scope, lines, level):
+        """Python expression of the value a define binds"""
+        if parts is None:
+            return self.expression(exp[2], scope, lines, level)
+        name, paras, body = parts
+        return self.procedure(self.function(name, paras, body, scope, lines,
+            level), len(paras), name)
+
+    def statement(self, exp, scope, lines, level):
+        """Write exp evaluated for effect"""
+        if is_definition(exp) or is_memoized_definition(exp):
+            self.definition(exp, scope, lines, level)
+        elif is_set(exp):
+            value = self.expression(exp[2], scope, lines, level)
+            binding = self.lookup(exp[1], scope)
+            if binding is None or binding.static:
+                lines.append((level, '%s = %s'
+                    % (self.global_reference(exp[1]), value)))
+            else:
+                lines.append((level, '%s[0] = %s' % (binding.pyname, value)))
+        elif is_if(exp):
+            lines.append((level, 'if %s:'
+                % self.test(exp[1], scope, lines, level)))
+            self.block(exp[2], scope, lines, level + 1)
+            if len(exp) == 4:
+                lines.append((level, 'else:'))
+                self.block(exp[3], scope, lines, level + 1)
+        elif is_sequence(exp):
+            for e in exp[1:]:
+                self.statement(e, scope, lines, level)
+        elif isinstance(exp, list) and exp:
+            lines.append((level, self.expression(exp, scope, lines, level)))
+
+    def block(self, exp, scope, lines, level):
+        """Write statement as an indented block"""
+        count = len(lines)
+        self.statement(exp, scope, lines, level)
+        if len(lines) == count:
+            lines.append((level, 'pass'))
+
+    def tail(self, exp, scope, lines, level, loop):
+        """Write exp in tail position, returning its value"""
+        if is_immediate_lambda(exp):
+            exp = lambda_to_let(exp)
+        if is_if(exp):
+            lines.append((level, 'if %s:'
+                % self.test(exp[1], scope, lines, level)))
+            self.tail(exp[2], scope, lines, level + 1, loop)
+            self.tail(exp[3] if len(exp) == 4 else None, scope, lines, level,
+                loop)
+        elif is_cond(exp):
+            for clause in exp[1:]:
+                if clause[0] == 'else':
+                    self.tail(clause_to_exp(clause), scope, lines, level, loop)
+                    return
+                lines.append((level, 'if %s:'
+                    % self.test(clause[0], scope, lines, level)))
+                self.tail(clause_to_exp(clause), scope, lines, level + 1,
+                    loop)
+            lines.append((level, 'return None'))
+        elif is_sequence(exp):
+            for e in exp[1:-1]:
+                self.statement(e, scope, lines, level)
+            self.tail(exp[-1] if len(exp) > 1 else None, scope, lines, level,
+                loop)
+        elif is_let(exp):
+            frame = {}
+            assigned = assigned_names(exp[2:])
+            for name, init in exp[1]:
+                value = self.expression(init, scope, lines, level)
+                frame[name] = Binding(self.fresh(name), name in assigned)
+                if frame[name].boxed:
+                    value = '[%s]' % value
+                lines.append((level, '%s = %s' % (frame[name].pyname, value)))
+            self.body(exp[2:], scope + [frame], lines, level, loop)
+        elif is_cons_stream(exp):
+            self.tail(cons_stream_to_cons(exp), scope, lines, level, loop)
+        elif (is_definition(exp) or is_memoized_definition(exp)
+                or is_set(exp)):
+            self.statement(exp, scope, lines, level)
+            lines.append((level, 'return None'))
+        elif (loop is not None and is_application(exp)
+                and is_identifier(exp[0])
+                and self.lookup(exp[0], scope) is loop.binding
+                and len(exp) - 1 == len(loop.params)):
+            args = [self.expression(e, scope, lines, level) for e in exp[1:]]
+            if args:
+                lines.append((level, '%s = %s' % (', '.join(loop.params),
+                    ', '.join(args))))
+            lines.append((level, 'continue'))
+            loop.used = True
+        elif exp is None:
+            lines.append((level, 'return None'))
+        elif self.needs_trampoline(exp):
+            self.check_tail(exp, scope)
+            binding = None
+            if is_identifier(exp[0]):
+                binding = self.lookup(exp[0], scope)
+            args = [self.expression(e, scope, lines, level) for e in exp[1:]]
+            if (binding is not None and not binding.boxed
+                    and binding.arity == len(args)):
+                proc = binding.pyname
+            else:
+                proc = self.expression(exp[0], scope, lines, level)
+            lines.append((level, 'return TailCall(%s, [%s])'
+                % (proc, ', '.join(args))))
+            self.trampolines[-1] = True
+        else:
+            self.check_tail(exp, scope)
+            lines.append((level, 'return %s'
+                % self.expression(exp, scope, lines, level)))
+
+def compile_to_python(code):
+    """Source of a Python module running Scheme code
+
+    Importing it evaluates the program in the module's env; the value of
+    the last form is its result. The code is neither profiled nor
+    charged to a budget.
+    """
+    forms = []
+    macros = {}
+    for exp in read(code):
+        exp = expand(exp, macros)
+        if is_sequence(exp):
+            forms.extend(exp[1:])
+        else:
+            forms.append(exp)
+    return Transpiler(['begin'] + forms).module(forms)
+
+def compile_file(path, out=None):
+    """Compile Scheme file to a Python module and its .pyc, next to the
+    source by default; return the module path
+    """
+    if out is None:
+        out = os.path.splitext(path)[0] + '.py'
+    with open(path) as f:
+        source = compile_to_python(f.read())
+    with open(out, 'w') as f:
+        f.write(source)
+    py_compile.compile(out, doraise=True)
+    return out
+
+# Tiering
+
+# interpreted calls of a procedure before it is specialized
+HOT_CALLS = 500
+# guard failures before a specialized version is dropped for good
+MAX_DEOPTS = 10
+# argument types procedures are specialized for
+NUMBER_TYPES = (int, long, float)
+
+# procedures specialized so far, for tiering_stats
+_specialized = weakref.WeakSet()
+
+class Unspecializable(Exception):
+    """Procedure the specializer does not handle"""
+
+class Specializer(Transpiler):
+    """Compile the body of a hot Lambda to a Python function
+
+    Free variables are read from the frame of the parent environment they
+    are found in when specializing. Inlined primitives are guarded like
+    the arguments: the specialized version falls back to evaluate once
+    one of their names is bound to something else. Tail calls must go to
+    the procedure itself or to primitives, so the Python stack only grows
+    where evaluate's would.
+    """
+
+    def __init__(self, proc):
+        """Initialize with the procedure"""
+        Transpiler.__init__(self, ['lambda', proc.get_paras()]
+            + proc.get_body())
+        self.proc = proc
+        self.frames = {}
+        self.namespace = {}
+        # conditions under which inlining the primitives used is correct
+        self.assumptions = {}
+
+    def frame_of(self, name):
+        """Python name of the environment name is found in, and the
+        environment
+        """
+        env = self.proc.get_parent_env()
+        while name not in env:
+            if '**parent**' not in env:
+                raise Unspecializable('Undefine variable : ' + name)
+            env = env['**parent**']
+        if id(env) not in self.frames:
+            self.frames[id(env)] = self.fresh('frame')
+            self.namespace[self.frames[id(env)]] = env
+        return self.frames[id(env)], env
+
+    def literal(self, value):
+        """Python expression of constant, bound in the namespace"""
+        name = self.fresh('constant')
+        self.namespace[name] = value
+        return name
+
+    def global_reference(self, name):
+        """Python expression of free variable"""
+        return '%s[%r]' % (self.frame_of(name)[0], name)
+
+    def inlinable(self, name):
+        """Is name bound to the base primitive of that name?"""
+        if name in self.bound:
+            return False
+        try:
+            frame, env = self.frame_of(name)
+        except Unspecializable:
+            return False
+        value = env[name]
+        if not isinstance(value, PrimitiveFunction) or value.name != name:
+            return False
+        if name not in self.assumptions:
+            primitive = self.fresh('primitive')
+            self.namespace[primitive] = value
+            self.assumptions[name] = '%s[%r] is %s' % (frame, name,
+                primitive)
+        return True
+
+    def needs_trampoline(self, exp):
+        """Specialized code is called in place of evaluate, check_tail
+        keeps its tail calls from growing the stack
+        """
+        return False
+
+    def check_tail(self, exp, scope):
+        """Refuse tail calls to procedures other than primitives and the
+        procedure itself
+        """
+        if not is_application(exp) or is_quote(exp):
             return
+        name = exp[0]
+        if is_identifier(name):
+            for table in (INLINE_OPERATORS, INLINE_PREDICATES):
+                if (name in table and table[name][0] == len(exp) - 1
+                        and self.inlinable(name)):
+                    return
+            binding = self.lookup(name, scope)
+            if binding is not None and binding.static:
+                return
+            if binding is None and isinstance(self.frame_of(name)[1][name],
+                    PrimitiveFunction):
+                return
+        raise Unspecializable('Tail call : ' + to_string(exp))
+
+    def compile(self, signature):
+        """Python function of the procedure for arguments of these types"""
+        proc = self.proc
+        paras = proc.get_paras()
+        body = proc.get_body()
+        if makes_closure(body) or assigned_names(body) & set(paras):
+            raise Unspecializable('Closures or assigned parameters')
+        name = proc.get_name()
+        conditions = []
+        binding = None
+        if name is not None and name not in self.bound:
+            try:
+                frame, env = self.frame_of(name)
+            except Unspecializable:
+                pass
+            else:
+                if env[name] is proc:
+                    binding = Binding(self.fresh(name), arity=len(paras),
+                        static=True)
+                    self.globals[name] = binding
+                    conditions.append('%s[%r] is proc' % (frame, name))
+        def guard(params):
+            tests = ['%s.__class__ is %s' % (p, cls.__name__)
+                for p, cls in zip(params, signature)] + conditions + [
+                self.assumptions[n] for n in sorted(self.assumptions)]
+            if not tests:
+                return []
+            return [(0, 'if not (%s):' % ' and '.join(tests)),
+                (1, 'return deoptimize(proc, [%s])' % ', '.join(params))]
+        lines = []
+        pyname = self.function(name or 'lambda', paras, body, [], lines, 0,
+            binding, guard)
+        source = '\n'.join(self.constants + [
+            '    ' * level + line for level, line in lines]) + '\n'
+        self.namespace.update(CONS=CONS, FALSE=FALSE, MEMOIZE=MEMOIZE, NIL=NIL,
+            Pair=Pair, Promise=Promise, String=String, TRUE=TRUE,
+            call_procedure=call_procedure, deoptimize=deoptimize,
+            make_procedure=make_procedure, pylist_to_pairs=pylist_to_pairs,
+            proc=proc)
+        exec compile(source, '<specialized %s>' % name, 'exec') \
+            in self.namespace
+        return self.namespace[pyname]
 
+def specialize(proc, args):
+    """Replace hot procedure by a version for the types of args, when all
+    are numbers and the specializer handles it
+    """
+    signature = tuple(a.__class__ for a in args)
+    if len(args) != len(proc.get_paras()) or not all(
+            cls in NUMBER_TYPES for cls in signature):
+        return
+    try:
+        proc.specialized = Specializer(proc).compile(signature)
+    except Unspecializable:
+        return
+    proc.signature = signature
+    _specialized.add(proc)
+
+def deoptimize(proc, args):
+    """Run procedure generically, after a guard of its specialized version
+    failed
+    """
+    proc.deopts += 1
+    if proc.deopts >= MAX_DEOPTS:
+        proc.specialized = None
+    env = dict(zip(proc.get_paras(), args))
+    env['**parent**'] = proc.get_parent_env()
+    return evaluate(proc.get_sequence(), env)
+
+def tiering_stats():
+    """Procedures that were specialized, most called first
+
+    Each is a dict of name, interpreted calls, argument type names, guard
+    failures and whether the specialized version is still used.
+    """
+    stats = [{'name': procedure_name(proc), 'calls': proc.calls,
+        'types': [cls.__name__ for cls in proc.signature],
+        'deopts': proc.deopts, 'active': proc.specialized is not None}
+        for proc in list(_specialized)]
+    stats.sort(key=lambda s: -s['calls'])
+    return stats
 
 def make_base():
     """Make base Environment"""
-    env = {}
+    env = Environment()
 
     # Primitive functions
     env['display'] = PrimitiveFunction(display)
-    env['cons'] = PrimitiveFunction(cons)
-    env['car'] = PrimitiveFunction(car)
-    env['cdr'] = PrimitiveFunction(cdr)
-    env['+'] = PrimitiveFunction(add)
-    env['-'] = PrimitiveFunction(sub)
-    env['*'] = PrimitiveFunction(mul)
-    env['/'] = PrimitiveFunction(div)
-    env['>'] = PrimitiveFunction(gt)
-    env['>='] = PrimitiveFunction(gt)
-    env['<'] = PrimitiveFunction(lt)
-    env['<='] = PrimitiveFunction(le)
-    env['='] = PrimitiveFunction(eq)
-    env['eq?'] = PrimitiveFunction(eq_question_mark)
+    env['cons'] = CONS
+    env['car'] = PrimitiveFunction(car, operator.attrgetter('car'), 1)
+    env['cdr'] = PrimitiveFunction(cdr, operator.attrgetter('cdr'), 1)
+    env['list'] = PrimitiveFunction(make_list)
+    env['null?'] = PrimitiveFunction(null_question_mark,
+        unary_null_question_mark, 1)
+    env['pair?'] = PrimitiveFunction(pair_question_mark)
+    env['force'] = PrimitiveFunction(force)
+    # aliases are primitives of their own, named after their own key
+    env['stream-car'] = PrimitiveFunction(car, operator.attrgetter('car'), 1)
+    env['stream-cdr'] = PrimitiveFunction(stream_cdr)
+    env['stream-null?'] = PrimitiveFunction(null_question_mark,
+        unary_null_question_mark, 1)
+    env['stream-pair?'] = PrimitiveFunction(pair_question_mark)
+    env['the-empty-stream'] = NIL
+    env['stream-map'] = PrimitiveFunction(stream_map)
+    env['stream-filter'] = PrimitiveFunction(stream_filter)
+    env['stream-for-each'] = PrimitiveFunction(stream_for_each)
+    env['stream->list'] = PrimitiveFunction(stream_to_list)
+    env['read-lines'] = PrimitiveFunction(read_lines)
+    env['make-vector'] = PrimitiveFunction(make_vector)
+    env['vector'] = PrimitiveFunction(vector)
+    env['vector?'] = PrimitiveFunction(vector_question_mark)
+    env['vector-ref'] = PrimitiveFunction(vector_ref, Vector.ref, 2)
+    env['vector-set!'] = PrimitiveFunction(vector_set)
+    env['vector-length'] = PrimitiveFunction(vector_length, len, 1)
+    env['list->vector'] = PrimitiveFunction(list_to_vector, Vector, 1)
+    env['vector->list'] = PrimitiveFunction(vector_to_list)
+    env['vector-map'] = PrimitiveFunction(vector_map)
+    env['vector-fold'] = PrimitiveFunction(vector_fold)
+    env['make-hash-table'] = PrimitiveFunction(make_hash_table)
+    env['hash-table-ref'] = PrimitiveFunction(hash_table_ref,
+        HashTable.ref, 2)
+    env['hash-table-ref/default'] = PrimitiveFunction(hash_table_ref_default)
+    env['hash-table-set!'] = PrimitiveFunction(hash_table_set)
+    env['hash-table-delete!'] = PrimitiveFunction(hash_table_delete)
+    env['hash-table-exists?'] = PrimitiveFunction(hash_table_exists)
+    env['hash-table-count'] = PrimitiveFunction(hash_table_count)
+    env['hash-table-walk'] = PrimitiveFunction(hash_table_walk)
+    env['memoize'] = MEMOIZE
+    env['memo-stats'] = PrimitiveFunction(memo_stats)
+    env['memo-clear!'] = PrimitiveFunction(memo_clear)
+    env['pmap'] = PrimitiveFunction(pmap)
+    env['parallel-for-each'] = PrimitiveFunction(parallel_for_each)
+    env['+'] = PrimitiveFunction(add, operator.add, 2)
+    env['-'] = PrimitiveFunction(sub, operator.sub, 2)
+    env['*'] = PrimitiveFunction(mul, operator.mul, 2)
+    env['/'] = PrimitiveFunction(div, operator.div, 2)
+    env['>'] = PrimitiveFunction(gt, binary_gt, 2)
+    env['>='] = PrimitiveFunction(ge, binary_ge, 2)
+    env['<'] = PrimitiveFunction(lt, binary_lt, 2)
+    env['<='] = PrimitiveFunction(le, binary_le, 2)
+    env['='] = PrimitiveFunction(eq, binary_eq, 2)
+    env['eq?'] = PrimitiveFunction(eq_question_mark,
+        binary_eq_question_mark, 2)
 
+    env['load-file'] = PrimitiveFunction(
+        lambda args: run_file(args[0], env, cache_dir=CACHE_DIR))
     # Constants
-    env['#f'] = make_boolean(False)
-    env['#t'] = make_boolean(True)
+    env['#f'] = FALSE
+    env['#t'] = TRUE
 
+    name_primitives(env)
     return env
 
-def run(code, env):
-    return evaluate(parse(code), env)
+def run(code, env, optimized=False, profiler=None, budget=None):
+    """Evaluate Scheme code form by form, return the last result"""
+    result = None
+    macros = get_macros(env)
+    with profiling(profiler), budgeting(budget):
+        for exp in read(code):
+            exp = expand(exp, macros)
+            if optimized:
+                exp = optimize(exp, env)
+            result = evaluate(exp, env)
+    return result
+
+def run_explicit(code, env, budget=None):
+    """Evaluate Scheme code form by form without growing the Python stack"""
+    result = None
+    macros = get_macros(env)
+    with budgeting(budget):
+        for exp in read(code):
+            result = evaluate_explicit(expand(exp, macros), env)
+    return result
+
+def run_compiled(code, env, optimized=False, profiler=None, budget=None):
+    """Analyze and execute Scheme code form by form"""
+    result = None
+    macros = get_macros(env)
+    with profiling(profiler), budgeting(budget):
+        for exp in read(code):
+            exp = expand(exp, macros)
+            if optimized:
+                exp = optimize(exp, env)
+            result = analyze(exp)(env)
+    return result
+
+# Files
+
+def cache_path(source, cache_dir):
+    """Cache file of source, changes with the source and the interpreter"""
+    key = hashlib.sha1(__version__ + '\0' + source).hexdigest()
+    return os.path.join(cache_dir, key + '.pickle')
+
+def load_forms(path, cache_dir=CACHE_DIR):
+    """Parsed forms of Scheme file, from the cache when it is fresh
+
+    A missing, unreadable or corrupt cache falls back to parsing and is
+    rewritten. Failing to write it is not an error, like .pyc files.
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    if cache_dir is None:
+        return list(read(source))
+    cache = cache_path(source, cache_dir)
+    try:
+        with open(cache, 'rb') as f:
+            return cPickle.load(f)
+    except Exception:
+        pass
+    forms = list(read(source))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write aside and rename, a concurrent reader never sees half
+        fd, temp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(forms, f, 2)
+        os.rename(temp, cache)
+    except (IOError, OSError):
+        pass
+    return forms
+
+def run_file(path, env, compiled=False, cache_dir=CACHE_DIR):
+    """Evaluate Scheme file form by form, return the last result"""
+    result = None
+    macros = get_macros(env)
+    for exp in load_forms(path, cache_dir):
+        exp = expand(exp, macros)
+        if compiled:
+            result = analyze(exp)(env)
+        else:
+            result = evaluate(exp, env)
+    return result
+
+# Images
+
+def make_pickler(f, env=None):
+    """Pickler writing primitives by name and env as a reference"""
+    def persistent_id(obj):
+        if env is not None and obj is env:
+            return 'env'
+        elif obj.__class__ is PrimitiveFunction:
+            if obj.name is None:
+                raise Exception('Cannot pickle primitive without a name : '
+                    + str(obj.get_func()))
+            return ('primitive', obj.name)
+        return None
+    pickler = cPickle.Pickler(f, 2)
+    pickler.persistent_id = persistent_id
+    return pickler
+
+def make_unpickler(f, env):
+    """Unpickler resolving primitives and the env reference in env"""
+    def persistent_load(pid):
+        if pid == 'env':
+            return env
+        name = pid[1]
+        proc = env.get(name)
+        if not isinstance(proc, PrimitiveFunction):
+            raise Exception('Unknown primitive : ' + name)
+        return proc
+    unpickler = cPickle.Unpickler(f)
+    unpickler.persistent_load = persistent_load
+    return unpickler
+
+def name_primitives(env):
+    """Name primitives of env that have no name by their key"""
+    for name, value in env.items():
+        if isinstance(value, PrimitiveFunction):
+            name_procedure(value, name)
+
+def save_image(env, path):
+    """Write environment and everything reachable from it to path
+
+    Primitives are written by name and looked up again on load, the
+    environment itself is restored into the one load_image is given,
+    along with its macros.
+    """
+    name_primitives(env)
+    with open(path, 'wb') as f:
+        make_pickler(f, env).dump((dict(env), get_macros(env)))
+
+def load_image(path, env=None):
+    """Restore environment saved by save_image into env, make_base() by
+    default, and return it
+    """
+    if env is None:
+        env = make_base()
+    with open(path, 'rb') as f:
+        variables, macros = make_unpickler(f, env).load()
+    env.update(variables)
+    get_macros(env).update(macros)
+    return env
+
+# Parallel map
+
+# worker processes, created by the first pmap and reused
+_pool = None
+_pool_size = None
+# primitives of values sent to and from workers are resolved here
+_primitives = None
+
+def set_pool_size(processes=None):
+    """Number of pmap workers, None for one per CPU; running workers are
+    replaced on the next pmap
+    """
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+    _pool_size = processes
+
+def get_pool():
+    """Worker pool, started on first use"""
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(_pool_size)
+    return _pool
+
+def dumps(obj, env=None):
+    """Pickle value sent between processes, env goes as a reference"""
+    f = StringIO()
+    make_pickler(f, env).dump(obj)
+    return f.getvalue()
+
+def loads(data, env=None):
+    """Unpickle value sent between processes, resolving the env reference
+    and primitives in env, a base environment by default
+    """
+    global _primitives
+    if env is None:
+        if _primitives is None:
+            _primitives = make_base()
+        env = _primitives
+    return make_unpickler(StringIO(data), env).load()
+
+def global_environment(proc):
+    """Global environment a procedure's free variables end up in, None
+    for primitives
+    """
+    if isinstance(proc, MemoizedProcedure):
+        proc = proc.proc
+    if isinstance(proc, CompiledLambda):
+        return proc.top
+    elif isinstance(proc, Lambda):
+        env = proc.get_parent_env()
+        while '**parent**' in env:
+            env = env['**parent**']
+        return env
+    return None
+
+def referenced_globals(proc, env):
+    """Bindings of env the procedure may use, directly or through the
+    procedures and data it calls or captures, walked with an explicit
+    stack
+    """
+    result = {}
+    seen = set()
+    pending = [proc]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        # code run in a chain of frames ending in env, and the frames
+        code = frame = None
+        if isinstance(obj, Pair):
+            pending.append(obj.cdr)
+            pending.append(obj.car)
+        elif isinstance(obj, Vector):
+            pending.extend(obj.items)
+        elif isinstance(obj, HashTable):
+            for key, value in obj.table.values():
+                pending.append(key)
+                pending.append(value)
+        elif isinstance(obj, Cell):
+            pending.append(obj.value)
+        elif isinstance(obj, Promise):
+            if obj.func is None:
+                pending.append(obj.value)
+            elif obj.func in (evaluate, evaluate_explicit):
+                code, frame = obj.args
+            else:
+                pending.extend(obj.args)
+        elif isinstance(obj, MemoizedProcedure):
+            pending.append(obj.proc)
+        elif isinstance(obj, CompiledLambda):
+            pending.extend(obj.free)
+            code = obj.get_body()
+        elif isinstance(obj, Lambda):
+            code, frame = obj.get_body(), obj.get_parent_env()
+        if code is None:
+            continue
+        # frames between the code and env are sent whole
+        while frame is not None and frame is not env and '**parent**' in frame:
+            pending.extend(frame.values())
+            frame = frame['**parent**']
+        for name in captured_names(code, inside=True):
+            if name in env and name not in result:
+                value = result[name] = env[name]
+                if isinstance(value, PrimitiveFunction):
+                    name_procedure(value, name)
+                pending.append(value)
+    return result
+
+def pmap_worker(task):
+    """Apply procedure to each argument tuple of a chunk, in a worker"""
+    global _primitives
+    if _primitives is None:
+        _primitives = make_base()
+    proc, chunk = task
+    env = dict(_primitives)
+    proc, bindings = loads(proc, env)
+    env.update(bindings)
+    return dumps([apply_procedure(proc, list(args))
+        for args in loads(chunk, env)], env)
+
+def parallel_apply(args):
+    """Results of applying args[0] across the lists in args[1:], in order
+
+    The procedure is pickled once with the globals it references rather
+    than its whole environment; the arguments go in about four chunks per
+    worker.
+    """
+    env = global_environment(args[0])
+    bindings = referenced_globals(args[0], env) if env is not None else {}
+    proc = dumps((args[0], bindings), env)
+    tuples = zip(*[list(lst) for lst in args[1:]])
+    pool = get_pool()
+    size = max(1, -(-len(tuples) // (4 * pool._processes)))
+    tasks = [(proc, dumps(tuples[i:i + size], env))
+        for i in range(0, len(tuples), size)]
+    results = []
+    for chunk in pool.map(pmap_worker, tasks):
+        results.extend(loads(chunk, env))
+    return results
+
+def pmap(args):
+    """pmap, like map with applications spread over worker processes"""
+    return make_list(parallel_apply(args))
+
+def parallel_for_each(args):
+    """parallel-for-each, side effects stay in the worker processes"""
+    parallel_apply(args)
+
+# Asynchronous evaluation
+
+class Future(object):
+    """Result that becomes available later, same interface as
+    concurrent.futures.Future without the blocking
+    """
+
+    def __init__(self):
+        """Initialize pending"""
+        self.__done = False
+        self.__result = None
+        self.__exception = None
+        self.__callbacks = []
+
+    def done(self):
+        """Is the result or exception set?"""
+        return self.__done
+
+    def result(self):
+        """Get result, raise the exception if one was set"""
+        if not self.__done:
+            raise Exception('Result is not ready')
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+    def exception(self):
+        """Get exception, None if it succeeded"""
+        if not self.__done:
+            raise Exception('Result is not ready')
+        return self.__exception
+
+    def add_done_callback(self, callback):
+        """Call callback with this future once it is done"""
+        if self.__done:
+            callback(self)
+        else:
+            self.__callbacks.append(callback)
+
+    def set_result(self, result):
+        """Finish with result"""
+        self.__finish(result, None)
+
+    def set_exception(self, exception):
+        """Finish with exception"""
+        self.__finish(None, exception)
+
+    def __finish(self, result, exception):
+        """Set outcome and run the callbacks"""
+        if self.__done:
+            raise Exception('Result is already set')
+        self.__done = True
+        self.__result = result
+        self.__exception = exception
+        callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+class Task(Future):
+    """Program run by the explicit-control evaluator, resumed by the
+    callbacks of the awaitables it waits for
+    """
+
+    def __init__(self, exp, env):
+        """Initialize with parsed program and environment, start running"""
+        Future.__init__(self)
+        self.__value = [None]
+        self.__machine = explicit_machine(exp, env, self.__value)
+        self.__step(None, None)
+
+    def __step(self, value, exception):
+        """Run until the next awaitable that is not done yet"""
+        while True:
+            try:
+                if exception is None:
+                    awaitable = self.__machine.send(value)
+                else:
+                    awaitable = self.__machine.throw(exception)
+            except StopIteration:
+                self.set_result(self.__value[0])
+                return
+            except Exception as e:
+                self.set_exception(e)
+                return
+            # done ones are continued here, so the Python stack stays flat
+            if not awaitable.done():
+                awaitable.add_done_callback(self.__wakeup)
+                return
+            value, exception = self.__outcome(awaitable)
+
+    def __wakeup(self, awaitable):
+        """Continue with the outcome of awaitable"""
+        self.__step(*self.__outcome(awaitable))
+
+    @staticmethod
+    def __outcome(awaitable):
+        """(result, None) or (None, exception) of a done awaitable"""
+        try:
+            return awaitable.result(), None
+        except Exception as e:
+            return None, e
+
+def run_async(code, env):
+    """Start Scheme code, return a Task finishing with the last result
+
+    Programs suspend at asynchronous primitives without blocking the
+    caller, so many of them can run on one event loop or thread.
+    """
+    return Task(expand(parse(code), get_macros(env)), env)
+
+# Sessions
+
+class Interpreter(object):
+    """Isolated session with its own symbol table, global environment and
+    output port; sessions in different threads do not interfere
+    """
+
+    def __init__(self, out=None, compiled=True, image=None):
+        """Initialize with output port (stdout by default), evaluator and
+        optional image to start from
+        """
+        self.symbols = {'#t': TRUE, '#f': FALSE}
+        self.out = out
+        self.compiled = compiled
+        with self.activate():
+            if image is None:
+                self.env = make_base()
+            else:
+                self.env = load_image(image)
+
+    @contextmanager
+    def activate(self, out=None):
+        """Make this the running Interpreter of the thread in the with
+        block, out overrides its output port
+        """
+        symbols, port = _state.symbols, _state.out
+        _state.symbols = self.symbols
+        _state.out = out or self.out
+        try:
+            yield self
+        finally:
+            _state.symbols, _state.out = symbols, port
+
+    def run(self, code, out=None, budget=None):
+        """Evaluate Scheme code in this session, return the last result"""
+        with self.activate(out):
+            if self.compiled:
+                return run_compiled(code, self.env, budget=budget)
+            return run(code, self.env, budget=budget)
+
+    def run_file(self, path, out=None):
+        """Evaluate Scheme file in this session"""
+        with self.activate(out):
+            return run_file(path, self.env, self.compiled)
+
+# Server
+
+class EvalHandler(BaseHTTPRequestHandler):
+    """POST /eval runs the request body, in the session named by the
+    session query parameter or in a fresh one; DELETE /eval ends a session
+
+    Replies with a JSON object holding the printed value and the output,
+    or the error, and what the program cost when the server has limits.
+    """
+
+    def do_POST(self):
+        """Evaluate program"""
+        path, name = self.parse_path()
+        if path != '/eval':
+            return self.reply(404, {'error': 'Not found : ' + path})
+        code = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        interpreter, lock = self.server.get_session(name)
+        out = StringIO()
+        budget = self.server.make_budget()
+        with lock:
+            try:
+                body = {'value': to_string(interpreter.run(code, out, budget))}
+                status = 200
+            except Exception as e:
+                body = {'error': str(e)}
+                status = 400
+        body['output'] = out.getvalue()
+        if budget is not None:
+            body['cost'] = budget.get_stats()
+        self.reply(status, body)
+
+    def do_DELETE(self):
+        """End session"""
+        path, name = self.parse_path()
+        self.server.end_session(name)
+        self.reply(200, {})
+
+    def parse_path(self):
+        """Path and session name of the request"""
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        return url.path, query.get('session', [None])[0]
+
+    def reply(self, status, body):
+        """Send JSON response"""
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """Requests are not logged"""
+        pass
+
+class EvalServer(HTTPServer):
+    """HTTP server evaluating programs on a fixed pool of worker threads
+
+    Sessions live as long as the server, so a client pays for make_base()
+    once rather than per request; requests of one session run one at a
+    time.
+    """
+
+    def __init__(self, address, workers=4, image=None, limits=None):
+        """Initialize with (host, port), number of workers, optional image
+        every session starts from and Budget arguments for every request
+        """
+        HTTPServer.__init__(self, address, EvalHandler)
+        self.image = image
+        self.limits = limits
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.requests = Queue.Queue()
+        for _ in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        """Hand connection to the workers"""
+        self.requests.put((request, client_address))
+
+    def work(self):
+        """Serve queued connections"""
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def make_budget(self):
+        """Budget of a request, None without limits"""
+        if self.limits is None:
+            return None
+        return Budget(**self.limits)
+
+    def get_session(self, name):
+        """Interpreter and lock of named session, a fresh one for None"""
+        if name is None:
+            return Interpreter(image=self.image), threading.Lock()
+        with self.sessions_lock:
+            if name not in self.sessions:
+                self.sessions[name] = (Interpreter(image=self.image),
+                    threading.Lock())
+            return self.sessions[name]
+
+    def end_session(self, name):
+        """Forget named session"""
+        with self.sessions_lock:
+            self.sessions.pop(name, None)
+
+def serve(host='127.0.0.1', port=8765, workers=4, image=None, limits=None):
+    """Run evaluation server until interrupted"""
+    EvalServer((host, port), workers, image, limits).serve_forever()
+
+# Command line
+
+def main(argv=None):
+    """Run Scheme file, or compile it to a Python module with -c"""
+    parser = argparse.ArgumentParser(prog='pyscm',
+        description='Run or compile a Scheme program.')
+    parser.add_argument('file', help='Scheme source file')
+    parser.add_argument('-c', '--compile', action='store_true',
+        help='write a Python module instead of running the program')
+    parser.add_argument('-o', '--output',
+        help='module path, the source with .py by default')
+    args = parser.parse_args(argv)
+    if args.compile:
+        print compile_file(args.file, args.output)
+    else:
+        run_file(args.file, make_base(), compiled=True)
+    return 0
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    sys.exit(main())
@@ -1,45 +1,60 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
 import unittest
+import urllib2
+import StringIO
 import pyscm
 
 class TestParse(unittest.TestCase):
 
     def test_single_list(self):
-        self.assertEqual(['begin', ['+', '1', '2']],
+        self.assertEqual(['begin', ['+', 1, 2]],
             pyscm.parse('(+ 1 2)'))
         self.assertEqual(['begin', ['number?', 'x']],
             pyscm.parse('(number? x)'))
-        self.assertEqual(['begin', ['lambda', ['x'], ['+', 'x', '3']]],
+        self.assertEqual(['begin', ['lambda', ['x'], ['+', 'x', 3]]],
             pyscm.parse('(lambda (x) (+ x 3))'))
-        self.assertEqual(['begin', ['define', 'a', '5']],
+        self.assertEqual(['begin', ['define', 'a', 5]],
             pyscm.parse('(define a 5)'))
-        self.assertEqual(['begin', ['if', 'a', '#f', '1', '3']],
+        self.assertEqual(['begin', ['if', 'a', pyscm.make_boolean(False), 1, 3]],
             pyscm.parse('(if a #f 1 3)'))
 
     def test_nested_list(self):
-        self.assertEqual(['begin', ['+', ['*', 'a', 'b'], '4']],
+        self.assertEqual(['begin', ['+', ['*', 'a', 'b'], 4]],
             pyscm.parse('(+ (* a b) 4)'))
-        self.assertEqual(['begin', ['+', ['*', 'a', ['/', '12.3', '4.3']], '4']],
+        self.assertEqual(['begin', ['+', ['*', 'a', ['/', 12.3, 4.3]], 4]],
             pyscm.parse('(+ (* a (/ 12.3 4.3)) 4)'))
 
     def test_sequence(self):
-        self.assertEqual(['begin', ['+', '3', '4'], ['*', '1', '2']],
+        self.assertEqual(['begin', ['+', 3, 4], ['*', 1, 2]],
             pyscm.parse('(+ 3 4) (* 1 2)'))
-        self.assertEqual(['begin', ['+', '3', '4'], ['*', '1', '2']],
+        self.assertEqual(['begin', ['+', 3, 4], ['*', 1, 2]],
             pyscm.parse('(+ 3 4) \n\n(* 1 2)'))
 
     def test_sequence_and_nested(self):
-        self.assertEqual(['begin', ['+', ['a', '1', '2'], '4'], ['*', '1', '2']],
+        self.assertEqual(['begin', ['+', ['a', 1, 2], 4], ['*', 1, 2]],
             pyscm.parse('(+ (a 1 2) 4) (* 1 2)'))
 
     def test_quote(self):
-        self.assertEqual(['begin', ['quote', ['1', '2']]], pyscm.parse("'(1 2)"))
-        self.assertEqual(['begin', ['quote', ['define', 'a', '1']]],
+        self.assertEqual(['begin', ['quote', [1, 2]]], pyscm.parse("'(1 2)"))
+        self.assertEqual(['begin', ['quote', ['define', 'a', 1]]],
             pyscm.parse("'(define a 1)"))
         self.assertEqual(['begin', ['quote', 'a']], pyscm.parse("'a"))
 
     def test_data_type(self):
-        self.assertEqual(['begin', ['"hello"', '"world"', '#f', '#t', '1e4']],
-            pyscm.parse('("hello" "world" #f #t 1e4)'))
+        ast = pyscm.parse('("hello" "world" #f #t 1e4 -12 foo)')
+        self.assertEqual(['begin', ['hello', 'world', pyscm.make_boolean(False),
+            pyscm.make_boolean(True), 10000.0, -12, 'foo']], ast)
+        self.assertTrue(isinstance(ast[1][0], pyscm.String))
+        self.assertTrue(isinstance(ast[1][5], int))
+        self.assertFalse(isinstance(ast[1][6], pyscm.String))
+        self.assertTrue(ast[1][6] is intern('foo'))
+        self.assertEqual(['begin', 'a"b\\c\nd'],
+            pyscm.parse('"a\\"b\\\\c\\nd"'))
 
     def test_function(self):
         code = """
@@ -53,6 +68,28 @@ class TestParse(unittest.TestCase):
             'false']]]
         self.assertEqual(ast, pyscm.parse(code))
 
+    def test_string_and_comment(self):
+        self.assertEqual(['begin', ['display', 'hello (world) ; x'], 'a'],
+            pyscm.parse('(display "hello (world) ; x") ; comment (\na'))
+        self.assertEqual(['begin', ['quote', ['quote', 'a']],
+            ['quote', [1, ['quote', 'b']]]], pyscm.parse("''a '(1 'b)"))
+
+    def test_read(self):
+        source = StringIO.StringIO('(define s "two\nlines")\n; done\n(f s)\n')
+        forms = pyscm.read(source)
+        self.assertEqual(['define', 's', 'two\nlines'], next(forms))
+        self.assertEqual(['f', 's'], next(forms))
+        self.assertRaises(StopIteration, next, forms)
+        self.assertRaises(Exception, list, pyscm.read('(+ 1 2'))
+        self.assertRaises(Exception, list, pyscm.read('(+ 1 2))'))
+        self.assertRaises(Exception, list, pyscm.read('"abc'))
+
+    def test_unicode(self):
+        self.assertEqual(['begin', ['display', 'h\xc3\xa9llo'], 'caf\xc3\xa9'],
+            pyscm.parse(u'(display "h\xe9llo") caf\xe9'))
+        source = StringIO.StringIO(u'(f "\xe9")\n(g)')
+        self.assertEqual([['f', '\xc3\xa9'], ['g']], list(pyscm.read(source)))
+
 class TestPredicators(unittest.TestCase):
 
     def test_is_primitive(self):
@@ -70,6 +107,15 @@ class TestPredicators(unittest.TestCase):
         self.assertFalse(pyscm.is_variable('"foobar"'))
         self.assertFalse(pyscm.is_variable(['+', '1', '2']))
 
+    def test_is_self_evaluating(self):
+        self.assertTrue(pyscm.is_self_evaluating(12))
+        self.assertTrue(pyscm.is_self_evaluating(1.5))
+        self.assertTrue(pyscm.is_self_evaluating(pyscm.String('x')))
+        self.assertFalse(pyscm.is_self_evaluating('x'))
+        self.assertFalse(pyscm.is_self_evaluating(['+', 1, 2]))
+        self.assertTrue(pyscm.is_identifier('x'))
+        self.assertFalse(pyscm.is_identifier(pyscm.String('x')))
+
     def test_is_lambda(self):
         self.assertTrue(pyscm.is_lambda(['lambda',
             ['x'], ['+', '1', '2']]))
@@ -160,6 +206,18 @@ class TestPrimitiveFunction(unittest.TestCase):
         self.assertTrue(f is pyscm.ge([2, 4]))
         self.assertTrue(t is pyscm.gt([3, 1]))
 
+    def test_fast(self):
+        base = pyscm.make_base()
+        t = pyscm.TRUE
+        self.assertTrue(t is pyscm.make_boolean(True))
+        self.assertTrue(pyscm.FALSE is pyscm.make_boolean(False))
+        self.assertTrue(t is pyscm.run('(>= 2 2)', base))
+        self.assertTrue(t is pyscm.run_compiled('(>= 2 2)', base))
+        self.assertEqual(7, base['+'].fast(3, 4))
+        self.assertEqual(2.5, pyscm.run_compiled('(/ 5.0 2)', base))
+        self.assertEqual(10, pyscm.run_compiled('(+ 1 2 3 4)', base))
+        self.assertEqual(1, pyscm.run_compiled("(car (cons 1 '()))", base))
+
     def test_equal(self):
         t = pyscm.make_boolean(True)
         f = pyscm.make_boolean(False)
@@ -179,15 +237,340 @@ class TestPrimitiveFunction(unittest.TestCase):
                 pyscm.evaluate(['quote', []], {})
             ]))
 
+class TestPair(unittest.TestCase):
+
+    def test_cons(self):
+        p = pyscm.cons([1, pyscm.NIL])
+        self.assertTrue(isinstance(p, pyscm.Pair))
+        self.assertEqual(1, pyscm.car([p]))
+        self.assertTrue(pyscm.cdr([p]) is pyscm.NIL)
+        self.assertRaises(AttributeError, setattr, p, 'foo', 1)
+
+    def test_pylist_to_pairs(self):
+        p = pyscm.pylist_to_pairs([1, ['a', pyscm.String('b')], []])
+        self.assertEqual(1, p.car)
+        self.assertTrue(p.cdr.car.car is pyscm.make_symbol('a'))
+        self.assertTrue(p.cdr.cdr.car is pyscm.NIL)
+        self.assertEqual([1, 2, 3],
+            pyscm.pairs_to_pylist(pyscm.pylist_to_pairs([1, 2, 3])))
+        self.assertEqual('(1 (a b) ())', pyscm.to_string(p))
+        self.assertEqual('(1 . 2)', pyscm.to_string(pyscm.Pair(1, 2)))
+
+    def test_list_primitives(self):
+        base = pyscm.make_base()
+        t = pyscm.make_boolean(True)
+        self.assertTrue(t is pyscm.run("(null? '())", base))
+        self.assertTrue(t is pyscm.run("(pair? (list 1 2))", base))
+        self.assertEqual([1, 3], pyscm.pairs_to_pylist(
+            pyscm.run("(list 1 (+ 1 2))", base)))
+
+    def test_display(self):
+        out = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            pyscm.run("(display (cons 0 '(1 \"two\" (3))))", pyscm.make_base())
+        finally:
+            sys.stdout = stdout
+        self.assertEqual('(0 1 two (3))', out.getvalue())
+
+    def test_large_structures(self):
+        deep = []
+        for i in range(50000):
+            deep = [deep, i]
+        p = pyscm.pylist_to_pairs(deep)
+        text = pyscm.to_string(p)
+        self.assertTrue(text.startswith('(' * 50000 + '() 0) 1)'))
+        self.assertEqual(2 * 50000 + 2, text.count('(') + text.count(')'))
+        writes = []
+        class Port(object):
+            def write(self, s):
+                writes.append(s)
+        pyscm.write_object(pyscm.pylist_to_pairs(range(100000)), Port())
+        # written in pieces as it goes, not as one string
+        self.assertTrue(len(writes) > 10)
+        self.assertEqual(pyscm.to_string(pyscm.pylist_to_pairs(range(100000))),
+            ''.join(writes))
+        self.assertEqual('#(1 (2 . 3) #())', pyscm.to_string(pyscm.Vector(
+            [1, pyscm.Pair(2, 3), pyscm.Vector([])])))
+
+class TestVector(unittest.TestCase):
+
+    def test_storage(self):
+        self.assertEqual('l', pyscm.Vector([1, 2, 3]).items.typecode)
+        self.assertEqual('d', pyscm.Vector([1.5, 2.0]).items.typecode)
+        self.assertTrue(isinstance(pyscm.Vector([1, 2.0]).items, list))
+        v = pyscm.Vector([1, 2, 3])
+        v.set(0, 10)
+        self.assertEqual('l', v.items.typecode)
+        v.set(1, 'a')
+        self.assertEqual([10, 'a', 3], v.items)
+        v = pyscm.Vector([1, 2])
+        v.set(0, 2 ** 70)
+        self.assertEqual([2 ** 70, 2], v.items)
+
+    def test_primitives(self):
+        base = pyscm.make_base()
+        code = """
+        (define v (make-vector 3 0))
+        (vector-set! v 0 5)
+        (vector-set! v 2 (+ (vector-ref v 0) 1))
+        (define w (list->vector '(1 2 3)))
+        (list (vector-length v) (vector->list v) (vector? w) (vector? '()))
+        """
+        self.assertEqual('(3 (5 0 6) #t #f)',
+            pyscm.to_string(pyscm.run(code, base)))
+        self.assertEqual('(3 (5 0 6) #t #f)',
+            pyscm.to_string(pyscm.run_compiled(code, base)))
+        self.assertEqual('#(5 0 6)', pyscm.to_string(base['v']))
+
+    def test_bulk(self):
+        base = pyscm.make_base()
+        code = """
+        (define v (vector 1 2 3))
+        (define w (vector 0.5 1.5 2.5))
+        (list (+ v v) (* 2 v) (- w 0.5) (vector-map * v v)
+              (vector-map (lambda (x) (* x 10)) v)
+              (vector-map < v (vector 2 2 2))
+              (vector-fold + 0 v) (vector-fold (lambda (s x) (cons x s)) '() v))
+        """
+        self.assertEqual('(#(2 4 6) #(2 4 6) #(0.0 1.0 2.0) #(1 4 9) '
+            '#(10 20 30) #(#t #f #f) 6 (3 2 1))',
+            pyscm.to_string(pyscm.run(code, base)))
+        self.assertEqual('d', (base['w'] + base['w']).items.typecode)
+        self.assertRaises(Exception, pyscm.run,
+            '(+ v (vector 1 2))', base)
+        # primitives stop at the shortest vector, like procedures
+        self.assertEqual('(#(2 4) #(2 4) #(1.0 3.0))', pyscm.to_string(
+            pyscm.run('(list (vector-map + v (vector 1 2)) '
+            '(vector-map (lambda (a b) (+ a b)) v (vector 1 2)) '
+            '(vector-map + w (vector 0.5 1.5)))', base)))
+
+class TestHashTable(unittest.TestCase):
+
+    def test_keys(self):
+        base = pyscm.make_base()
+        code = """
+        (define h (make-hash-table))
+        (hash-table-set! h 1 'one)
+        (hash-table-set! h "two" 2)
+        (hash-table-set! h 'three 3)
+        (hash-table-set! h 'three 33)
+        (list (hash-table-ref h 1) (hash-table-ref h "two")
+              (hash-table-ref h 'three) (hash-table-count h)
+              (hash-table-ref h 'four (lambda () 4))
+              (hash-table-ref/default h 'five 5)
+              (hash-table-exists? h "two"))
+        """
+        self.assertEqual('(one 2 33 3 4 5 #t)',
+            pyscm.to_string(pyscm.run(code, base)))
+        self.assertEqual('(one 2 33 3 4 5 #t)',
+            pyscm.to_string(pyscm.run_compiled(code, base)))
+        self.assertRaises(Exception, pyscm.run, "(hash-table-ref h 'four)",
+            base)
+
+    def test_exact_and_inexact(self):
+        code = """
+        (define h (make-hash-table))
+        (hash-table-set! h 1 'exact)
+        (hash-table-set! h 1.0 'inexact)
+        (list (hash-table-ref h 1) (hash-table-ref h 1.0)
+              (hash-table-ref h (- (* 4294967296 4294967296)
+                                   (- (* 4294967296 4294967296) 1)))
+              (hash-table-exists? h 2.0) (hash-table-count h))
+        """
+        self.assertEqual('(exact inexact exact #f 2)',
+            pyscm.to_string(pyscm.run(code, pyscm.make_base())))
+
+    def test_delete_and_walk(self):
+        base = pyscm.make_base()
+        code = """
+        (define h (make-hash-table))
+        (hash-table-set! h 'a 1)
+        (hash-table-set! h 'b 2)
+        (hash-table-set! h 'c 3)
+        (hash-table-delete! h 'b)
+        (define total 0)
+        (hash-table-walk h (lambda (k v)
+            (set! total (+ total v))
+            (hash-table-delete! h k)))
+        (list total (hash-table-count h))
+        """
+        self.assertEqual('(4 0)', pyscm.to_string(pyscm.run(code, base)))
+
+class TestMemoize(unittest.TestCase):
+
+    def test_define_memoized(self):
+        code = """
+        (define calls 0)
+        (define-memoized (fib n)
+            (set! calls (+ calls 1))
+            (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+        (fib 60)
+        """
+        for run in (pyscm.run, pyscm.run_compiled, pyscm.run_explicit):
+            base = pyscm.make_base()
+            self.assertEqual(1548008755920, run(code, base))
+            self.assertEqual(61, base['calls'])
+            stats = base['fib'].get_stats()
+            self.assertEqual(61, stats['misses'])
+            self.assertEqual(58, stats['hits'])
+            self.assertEqual('((hits . 58) (misses . 61) (size . 61) '
+                '(max-size . 1024))',
+                pyscm.to_string(run('(memo-stats fib)', base)))
+
+    def test_eviction(self):
+        base = pyscm.make_base()
+        pyscm.run("""
+        (define sq (memoize (lambda (x) (* x x)) 2))
+        (sq 1) (sq 2) (sq 1) (sq 3) (sq 1) (sq 2)
+        """, base)
+        sq = base['sq']
+        self.assertEqual(2, sq.hits)
+        self.assertEqual(4, sq.misses)
+        self.assertEqual([((int, 1),), ((int, 2),)], list(sq.cache))
+        for size in ('0', '-1', '1.5'):
+            self.assertRaises(Exception, pyscm.run,
+                '(memoize (lambda (x) x) %s)' % size, base)
+
+    def test_key(self):
+        key = pyscm.memo_key
+        self.assertNotEqual(key(1), key(1.0))
+        self.assertEqual(key(pyscm.run("'(1 (2 a) b)", {})),
+            key(pyscm.run("'(1 (2 a) b)", {})))
+        self.assertNotEqual(key(pyscm.run("'(1 2)", {})),
+            key(pyscm.run("'(1 2 3)", {})))
+        self.assertNotEqual(key(pyscm.String('a')), key(pyscm.make_symbol('a')))
+
+class TestProfiler(unittest.TestCase):
+
+    code = """
+    (define (square x) (* x x))
+    (define (sum-squares n acc)
+        (if (= n 0) acc (sum-squares (- n 1) (+ acc (square n)))))
+    (sum-squares 3000 0)
+    """
+
+    def test_counts(self):
+        for run in (pyscm.run, pyscm.run_compiled):
+            profiler = pyscm.Profiler()
+            base = pyscm.make_base()
+            self.assertEqual(9004500500, run(self.code, base,
+                profiler=profiler))
+            self.assertEqual(3001, profiler.stats['sum-squares'][0])
+            self.assertEqual(3000, profiler.stats['square'][0])
+            self.assertEqual(3000, profiler.stats['*'][0])
+            self.assertEqual([], profiler.stack)
+
+    def test_time(self):
+        ticks = iter(range(100)).next
+        profiler = pyscm.Profiler(clock=ticks)
+        profiler.enter('f')
+        profiler.enter('g')
+        profiler.enter('f')
+        profiler.leave()
+        profiler.leave()
+        profiler.leave()
+        # f: 0..5 and 2..3, g: 1..4
+        self.assertEqual([2, 5, 3], profiler.stats['f'])
+        self.assertEqual([1, 3, 2], profiler.stats['g'])
+        out = StringIO.StringIO()
+        profiler.write_collapsed(out)
+        self.assertEqual(['f 2000000', 'f;g 2000000', 'f;g;f 1000000'],
+            sorted(out.getvalue().splitlines()))
+        out = StringIO.StringIO()
+        profiler.report(out, limit=1)
+        self.assertEqual(2, len(out.getvalue().splitlines()))
+
+    def test_disabled(self):
+        base = pyscm.make_base()
+        pyscm.run(self.code, base)
+        self.assertEqual(None, pyscm.current_profiler())
+
+    def test_per_thread(self):
+        profiler = pyscm.Profiler()
+        base = pyscm.make_base()
+        pyscm.run('(define (other n) n)', base)
+        with pyscm.profiling(profiler):
+            thread = threading.Thread(target=pyscm.run,
+                args=('(other 1)', base))
+            thread.start()
+            thread.join()
+            pyscm.run('(define (mine n) n) (mine 1)', base)
+        self.assertIn('mine', profiler.stats)
+        self.assertNotIn('other', profiler.stats)
+
 class TestSugar(unittest.TestCase):
 
     def test_let_to_lambda(self):
         ast = pyscm.parse('(let ((x 3) (y 4)) (+ x y))')[1]
         self.assertEqual(
-            [['lambda', ['x', 'y'], ['+', 'x', 'y']], '3', '4'],
+            [['lambda', ['x', 'y'], ['+', 'x', 'y']], 3, 4],
             pyscm.let_to_lambda(ast)
         )
 
+class TestOptimizer(unittest.TestCase):
+
+    def test_fold(self):
+        t = pyscm.make_boolean(True)
+        self.assertEqual(['f', 10, t],
+            pyscm.optimize(pyscm.parse('(f (+ 1 (* 3 3)) (< 1 2))')[1]))
+        self.assertEqual(['+', 'x', 2],
+            pyscm.optimize(pyscm.parse('(+ x (- 3 1))')[1]))
+        self.assertEqual(['/', 1, 0],
+            pyscm.optimize(pyscm.parse('(/ 1 0)')[1]))
+        # rebound names are left alone
+        self.assertEqual(['lambda', ['+'], ['+', 1, 2]],
+            pyscm.optimize(pyscm.parse('(lambda (+) (+ 1 2))')[1]))
+        env = pyscm.make_base()
+        pyscm.run('(define (* a b) 0)', env)
+        self.assertEqual(['*', 2, 3],
+            pyscm.optimize(pyscm.parse('(* 2 3)')[1], env))
+
+    def test_quote(self):
+        exp = pyscm.optimize(pyscm.parse("(f '((1 2) (3)) 'a '())")[1])
+        self.assertEqual('f', exp[0])
+        self.assertTrue(isinstance(exp[1], pyscm.Pair))
+        self.assertEqual('((1 2) (3))', pyscm.to_string(exp[1]))
+        self.assertTrue(exp[2] is pyscm.make_symbol('a'))
+        self.assertTrue(exp[3] is pyscm.NIL)
+
+    def test_prune(self):
+        optimize = lambda code: pyscm.optimize(pyscm.parse(code)[1])
+        self.assertEqual(['f', 1], optimize('(if (< 1 2) (f 1) (g 2))'))
+        self.assertEqual(['g', 2], optimize('(if (> 1 2) (f 1) (g 2))'))
+        self.assertEqual(None, optimize('(if (> 1 2) (f 1))'))
+        self.assertEqual(['cond', [['p', 'x'], 1], ['else', 2]],
+            optimize('(cond ((= 1 2) 0) ((p x) 1) ((= 1 1) 2) (else 3))'))
+        self.assertEqual(['begin', ['f'], 3],
+            optimize('(cond (#f 0) (else (f) 3))'))
+
+    def test_run(self):
+        code = """
+        (define (sum lst)
+            (if (eq? lst '())
+                0
+                (+ (car lst) (sum (cdr lst)))))
+        (define (f x)
+            (cond
+                ((> 1 2) 0)
+                ((< x 3) (* 2 (+ 1 2)))
+                (else (sum '(1 2 3)))))
+        (+ (f 1) (f 10))
+        """
+        self.assertEqual(12, pyscm.run(code, pyscm.make_base(), True))
+        self.assertEqual(12,
+            pyscm.run_compiled(code, pyscm.make_base(), optimized=True))
+
+    def test_debug(self):
+        err = StringIO.StringIO()
+        stderr, sys.stderr = sys.stderr, err
+        try:
+            pyscm.optimize(pyscm.parse(
+                '(if (= 1 1) (display \'(a "b") (* 2 3)))')[1], debug=True)
+        finally:
+            sys.stderr = stderr
+        self.assertEqual("(display '(a \"b\") 6)\n", err.getvalue())
+
 class TestEvaludator(unittest.TestCase):
 
     def test_primitive(self):
@@ -209,8 +592,8 @@ class TestEvaludator(unittest.TestCase):
 
     def test_definition(self):
         env = {}
-        pyscm.evaluate(['define', 'a', '3'], env)
-        pyscm.evaluate(['define', 'foo', '"bar"'], env)
+        pyscm.evaluate(['define', 'a', 3], env)
+        pyscm.evaluate(['define', 'foo', pyscm.String('bar')], env)
         pyscm.evaluate(['define', ['func', 'p1', 'p2'],
            ['+', 'p1', 'p2']], env)
         self.assertEqual(3, env['a'])
@@ -223,20 +606,20 @@ class TestEvaludator(unittest.TestCase):
 
     def test_set(self):
         env = {}
-        pyscm.evaluate(['define', 'a', '3'], env)
+        pyscm.evaluate(['define', 'a', 3], env)
         self.assertEqual(3, env['a'])
-        pyscm.evaluate(['set!', 'a', '4'], env)
+        pyscm.evaluate(['set!', 'a', 4], env)
         self.assertEqual(4, env['a'])
         env = {}
-        pyscm.evaluate(['define', 'a', '3'], env)
+        pyscm.evaluate(['define', 'a', 3], env)
         pyscm.evaluate(['define', ['f', 'x'], ['set!', 'a', 'x']], env)
-        pyscm.evaluate(['f', '9'], env)
+        pyscm.evaluate(['f', 9], env)
         self.assertEqual(9, env['a'])
 
     def test_sequence(self):
         env = {}
-        pyscm.evaluate(['begin', ['define', 'a', '3'],
-                                 ['define', 'foo', '"bar"'],
+        pyscm.evaluate(['begin', ['define', 'a', 3],
+                                 ['define', 'foo', pyscm.String('bar')],
                                  ['define', ['func', 'p1', 'p2'],
                                     ['+', 'p1', 'p2']]], env)
         self.assertEqual(3, env['a'])
@@ -319,5 +702,756 @@ class TestEvaludator(unittest.TestCase):
         self.assertEqual(500500, pyscm.run(code, pyscm.make_base()))
 
 
+class TestExplicit(unittest.TestCase):
+
+    def test_forms(self):
+        code = """
+        (define counter 0)
+        (define (f x)
+            (set! counter (+ counter 1))
+            (cond
+                ((< x 3) 1)
+                ((< x 5) (define y 2) (* x y))
+                (else (let ((z 3)) (if (> x 100) 0 (+ x z))))))
+        (begin)
+        (list (f 1) (f 4) (f 10) (if #f 1) counter)
+        """
+        result = pyscm.run_explicit(code, pyscm.make_base())
+        self.assertEqual([1, 8, 13, None, 3], pyscm.pairs_to_pylist(result))
+
+    def test_deep_recursion(self):
+        code = """
+        (define (build n acc) (if (= n 0) acc (build (- n 1) (cons n acc))))
+        (define (sum lst)
+            (if (eq? lst '())
+                0
+                (+ (car lst) (sum (cdr lst)))))
+        (sum (build 20000 '()))
+        """
+        self.assertEqual(200010000,
+            pyscm.run_explicit(code, pyscm.make_base()))
+
+    def test_interop(self):
+        base = pyscm.make_base()
+        pyscm.run_compiled('(define (twice f x) (f (f x)))', base)
+        pyscm.run('(define (inc x) (+ x 1))', base)
+        self.assertEqual(5, pyscm.run_explicit('(twice inc 3)', base))
+
+class TestRunFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dir, 'cache')
+        self.path = os.path.join(self.dir, 'lib.scm')
+        self.write('(define (f x) (if (eq? x \'a) #t "no")) (f \'a)')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, source):
+        with open(self.path, 'w') as f:
+            f.write(source)
+
+    def test_cache(self):
+        self.assertIs(pyscm.TRUE,
+            pyscm.run_file(self.path, pyscm.make_base(), cache_dir=self.cache))
+        self.assertEqual(1, len(os.listdir(self.cache)))
+        # a fresh cache is used without reading the source again
+        read = pyscm.read
+        pyscm.read = None
+        try:
+            self.assertIs(pyscm.TRUE, pyscm.run_file(self.path,
+                pyscm.make_base(), True, self.cache))
+        finally:
+            pyscm.read = read
+        self.write('(define (f x) (if (eq? x \'a) #t "no")) (f \'b)')
+        self.assertEqual('no',
+            pyscm.run_file(self.path, pyscm.make_base(), cache_dir=self.cache))
+        self.assertEqual(2, len(os.listdir(self.cache)))
+
+    def test_corrupt(self):
+        with open(self.path) as f:
+            cache = pyscm.cache_path(f.read(), self.cache)
+        os.mkdir(self.cache)
+        with open(cache, 'w') as f:
+            f.write('garbage')
+        self.assertIs(pyscm.TRUE,
+            pyscm.run_file(self.path, pyscm.make_base(), cache_dir=self.cache))
+        self.assertEqual(pyscm.load_forms(self.path, None),
+            pyscm.load_forms(self.path, self.cache))
+
+    def test_load_file(self):
+        base = pyscm.make_base()
+        pyscm.CACHE_DIR, cache_dir = self.cache, pyscm.CACHE_DIR
+        try:
+            self.assertIs(pyscm.TRUE, pyscm.run_compiled(
+                '(load-file "%s")' % self.path, base))
+        finally:
+            pyscm.CACHE_DIR = cache_dir
+        self.assertIsInstance(base['f'], pyscm.Lambda)
+
+class TestImage(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'base.image')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_image(self):
+        code = """
+        (define (make-counter)
+            (define n 0)
+            (lambda () (set! n (+ n 1)) n))
+        (define tick (make-counter))
+        (tick)
+        (define-memoized (fib n)
+            (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+        (fib 20)
+        (define data (list 'a "s" (vector 1 2) #t))
+        (define table (make-hash-table))
+        (hash-table-set! table 'k data)
+        (define plus +)
+        (define-syntax inc (syntax-rules () ((_ x) (+ x 1))))
+        """
+        for run in (pyscm.run, pyscm.run_compiled):
+            base = pyscm.make_base()
+            run(code, base)
+            base['old'] = pyscm.run('(define (old x) (* x 2)) old', base)
+            pyscm.save_image(base, self.path)
+            env = pyscm.load_image(self.path)
+            self.assertEqual(2, run('(tick)', env))
+            self.assertEqual(2, run('(inc 1)', env))
+            self.assertEqual(3, run('(tick)', env))
+            self.assertEqual(2, run('(tick)', base))
+            self.assertIs(env['+'], env['plus'])
+            self.assertIs(pyscm.make_symbol('a'), run('(car data)', env))
+            self.assertIs(run('data', env),
+                run("(hash-table-ref table 'k)", env))
+            self.assertIs(env, env['old'].get_parent_env())
+            self.assertEqual(8, run('(old 4)', env))
+            self.assertEqual(6765, run('(fib 20)', env))
+            self.assertEqual(19, env['fib'].hits)
+            self.assertEqual('(a s #(1 2) #t)', pyscm.to_string(env['data']))
+
+    def test_large_list_and_primitive(self):
+        base = pyscm.make_base()
+        base['big'] = pyscm.make_list(range(20000))
+        base['shared'] = pyscm.Pair(1, pyscm.Pair(2, pyscm.NIL))
+        base['alias'] = base['shared']
+        base['double'] = pyscm.PrimitiveFunction(lambda args: args[0] * 2)
+        pyscm.save_image(base, self.path)
+        self.assertEqual('double', base['double'].name)
+        env = pyscm.load_image(self.path, dict(pyscm.make_base(),
+            double=base['double']))
+        self.assertEqual(range(20000), list(env['big']))
+        self.assertIs(env['shared'], env['alias'])
+        self.assertIs(base['double'], env['double'])
+        self.assertRaises(Exception, pyscm.load_image, self.path)
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        pyscm.set_pool_size(2)
+
+    def tearDown(self):
+        pyscm.set_pool_size()
+
+    def test_pmap(self):
+        code = """
+        (define k 10)
+        (define (scale x) (* x k))
+        (define (pair-up x y) (cons (scale x) (list y 'a)))
+        (pmap pair-up (list 1 2 3 4 5 6 7 8 9 10 11) '(a b c d e f g h i j k))
+        """
+        expected = [pyscm.to_string(pyscm.run('(cons %d (list (quote %s) '
+            '(quote a)))' % (i * 10, c), pyscm.make_base()))
+            for i, c in zip(range(1, 12), 'abcdefghijk')]
+        for run in (pyscm.run, pyscm.run_compiled):
+            result = list(run(code, pyscm.make_base()))
+            self.assertEqual(expected, map(pyscm.to_string, result))
+            self.assertIs(pyscm.make_symbol('a'), result[0].cdr.cdr.car)
+        self.assertIs(pyscm.NIL,
+            pyscm.run("(pmap car '())", pyscm.make_base()))
+
+    def test_error(self):
+        base = pyscm.make_base()
+        self.assertRaises(Exception, pyscm.run,
+            "(pmap (lambda (x) (car x)) '(1))", base)
+        self.assertEqual(None, pyscm.run(
+            "(parallel-for-each display '())", base))
+
+    def test_references_only(self):
+        for run in (pyscm.run, pyscm.run_compiled):
+            base = pyscm.make_base()
+            base['double'] = pyscm.PrimitiveFunction(lambda args: args[0] * 2)
+            base['big'] = pyscm.make_list(range(5000))
+            code = '''
+            (define (upto n acc) (if (= n 0) acc (upto (- n 1) (cons n acc))))
+            (define (f n) (upto n '()))
+            (pmap f '(3000 1))
+            '''
+            result = list(run(code, base))
+            self.assertEqual(range(1, 3001), list(result[0]))
+            self.assertEqual([1], list(result[1]))
+            # a primitive the workers do not have fails only when used
+            self.assertRaises(Exception, run, "(pmap double '(1))", base)
+
+    def test_references_through_data(self):
+        code = '''
+        (define k 10)
+        (define (mk) (define (helper x) (* x k)) (lambda (x) (helper x)))
+        (define fs (list (lambda (x) (* x k))))
+        (define h (make-hash-table))
+        (hash-table-set! h 'f (lambda (x) (+ x k)))
+        (list (pmap (mk) (list 1 2))
+              (pmap (lambda (x) ((car fs) x)) (list 1 2))
+              (pmap (lambda (x) ((hash-table-ref h 'f) x)) (list 1 2)))
+        '''
+        for run in (pyscm.run, pyscm.run_compiled):
+            self.assertEqual('((10 20) (10 20) (11 12))',
+                pyscm.to_string(run(code, pyscm.make_base())))
+        self.assertEqual('(11)', pyscm.to_string(pyscm.run('''
+        (define k 10)
+        (define v (vector (delay k)))
+        (pmap (lambda (x) (+ x (force (vector-ref v 0)))) (list 1))
+        ''', pyscm.make_base())))
+
+class TestInterpreter(unittest.TestCase):
+
+    def test_isolation(self):
+        out = StringIO.StringIO()
+        first = pyscm.Interpreter(out)
+        second = pyscm.Interpreter(compiled=False)
+        first.run("(define x 'a) (display x)")
+        self.assertEqual('a', out.getvalue())
+        self.assertRaises(Exception, second.run, 'x')
+        a = first.run('x')
+        self.assertIsNot(a, second.run("'a"))
+        self.assertIsNot(a, pyscm.make_symbol('a'))
+        self.assertIs(pyscm.TRUE, first.run("(eq? x 'a)"))
+        self.assertIs(pyscm.TRUE, second.run("(eq? 'a 'a)"))
+        port = StringIO.StringIO()
+        second.run('(display "b")', port)
+        self.assertEqual('b', port.getvalue())
+        self.assertEqual('a', out.getvalue())
+
+    def test_server(self):
+        server = pyscm.EvalServer(('127.0.0.1', 0), 2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:%d/eval' % server.server_address[1]
+        def post(code, session=None):
+            try:
+                return json.load(urllib2.urlopen(url + (
+                    '?session=' + session if session else ''), code))
+            except urllib2.HTTPError as e:
+                return json.load(e)
+        try:
+            self.assertEqual({'value': '3', 'output': 'hi'},
+                post('(define x 3) (display "hi") x', 's'))
+            self.assertEqual('4', post('(+ x 1)', 's')['value'])
+            self.assertIn('error', post('x'))
+            self.assertIn('error', post('x', 't'))
+            request = urllib2.Request(url + '?session=s')
+            request.get_method = lambda: 'DELETE'
+            urllib2.urlopen(request)
+            self.assertIn('error', post('x', 's'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.pending = []
+        def fetch(args):
+            future = pyscm.Future()
+            self.pending.append((future, args[0]))
+            return future
+        self.base = pyscm.make_base()
+        self.base['fetch'] = pyscm.AsyncPrimitive(fetch)
+
+    def test_interleave(self):
+        code = """
+        (define (loop n acc)
+            (if (= n 0) acc (loop (- n 1) (+ acc (fetch n)))))
+        (loop 3 0)
+        """
+        tasks = [pyscm.run_async(code, self.base),
+            pyscm.run_async('(cons (fetch 10) (fetch 20))', self.base)]
+        self.assertEqual([3, 10], [arg for _, arg in self.pending])
+        while self.pending:
+            future, arg = self.pending.pop(0)
+            future.set_result(arg * 2)
+        self.assertEqual(12, tasks[0].result())
+        self.assertEqual('(20 . 40)', pyscm.to_string(tasks[1].result()))
+
+    def test_tail_calls(self):
+        def done(args):
+            future = pyscm.Future()
+            future.set_result(args[0])
+            return future
+        self.base['done'] = pyscm.AsyncPrimitive(done)
+        code = """
+        (define (loop n) (if (= n 0) 'end (loop (done (- n 1)))))
+        (loop 5000)
+        """
+        task = pyscm.run_async(code, self.base)
+        self.assertIs(pyscm.make_symbol('end'), task.result())
+        self.assertIs(pyscm.make_symbol('end'),
+            pyscm.run_explicit(code, self.base))
+        self.assertIs(pyscm.make_symbol('end'), pyscm.run(code, self.base))
+
+    def test_exception(self):
+        task = pyscm.run_async('(car (fetch 1))', self.base)
+        future, _ = self.pending.pop()
+        future.set_exception(ValueError('lost'))
+        self.assertRaises(ValueError, task.result)
+        task = pyscm.run_async('(car (fetch 1))', self.base)
+        self.assertFalse(task.done())
+        self.pending.pop()[0].set_result(1)
+        self.assertRaises(Exception, task.result)
+
+    def test_blocking(self):
+        def later(args):
+            future = pyscm.Future()
+            threading.Timer(0.01, future.set_result, [args[0] + 1]).start()
+            return future
+        self.base['later'] = pyscm.AsyncPrimitive(later)
+        for run in (pyscm.run, pyscm.run_compiled, pyscm.run_explicit):
+            self.assertEqual(3, run('(+ 1 (later 1))', self.base))
+
+class TestStream(unittest.TestCase):
+
+    def test_alias_names(self):
+        base = pyscm.make_base()
+        for name in ('car', 'null?', 'pair?', 'stream-car', 'stream-null?',
+                'stream-pair?'):
+            self.assertEqual(name, base[name].name)
+
+    def test_streams(self):
+        code = """
+        (define calls 0)
+        (define (integers-from n)
+            (cons-stream n (begin (set! calls (+ calls 1))
+                                  (integers-from (+ n 1)))))
+        (define (stream-ref s n)
+            (if (= n 0) (stream-car s) (stream-ref (stream-cdr s) (- n 1))))
+        (define nat (integers-from 0))
+        (stream-ref nat 10)
+        (stream-ref nat 10)
+        (define p (delay (+ 1 2)))
+        (list (stream-ref nat 5) calls (force p) (force p) (force 4)
+              (stream->list (stream-map (lambda (x) (* x x))
+                  (stream-filter (lambda (x) (= (- x (* 2 (/ x 2))) 1)) nat))
+                  4))
+        """
+        for run in (pyscm.run, pyscm.run_compiled, pyscm.run_explicit):
+            self.assertEqual('(5 10 3 3 4 (1 9 25 49))',
+                pyscm.to_string(run(code, pyscm.make_base())))
+        self.assertEqual('#<promise>', str(pyscm.run('(delay 1)', {})))
+
+    def test_read_lines(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'log')
+            with open(path, 'w') as f:
+                for i in range(20000):
+                    f.write('%s %d\n' % ('ERROR' if i % 7 == 0 else 'INFO', i))
+            code = """
+            (define count 0)
+            (stream-for-each (lambda (n) (set! count (+ count n)))
+                (stream-map (lambda (line) 1)
+                    (stream-filter error? (read-lines "%s"))))
+            count
+            """ % path
+            base = pyscm.make_base()
+            base['error?'] = pyscm.PrimitiveFunction(
+                lambda args: pyscm.make_boolean(args[0].startswith('ERROR')))
+            self.assertEqual(2858, pyscm.run(code, base))
+            self.assertEqual('(INFO 1 INFO 2)', pyscm.to_string(pyscm.run(
+                '(stream->list (stream-cdr (read-lines "%s")) 2)' % path,
+                base)))
+        finally:
+            shutil.rmtree(dir)
+
+class TestBudget(unittest.TestCase):
+
+    loop = "(define (loop n) (loop (+ n 1))) (loop 0)"
+
+    def test_fuel(self):
+        for run in (pyscm.run, pyscm.run_compiled, pyscm.run_explicit):
+            budget = pyscm.Budget(fuel=5000)
+            self.assertRaises(pyscm.OutOfFuel, run, self.loop,
+                pyscm.make_base(), budget=budget)
+            self.assertEqual(5001, budget.fuel)
+            self.assertEqual(budget.fuel, budget.steps + budget.calls)
+            self.assertIs(None, pyscm._state.budget)
+
+    def test_deadline(self):
+        ticks = iter(range(10 ** 6)).next
+        budget = pyscm.Budget(seconds=2, clock=ticks)
+        self.assertRaises(pyscm.DeadlineExceeded, pyscm.run_compiled,
+            self.loop, pyscm.make_base(), budget=budget)
+        # started at 0, the clock is read at every 1024 units
+        self.assertEqual(3072, budget.fuel)
+        self.assertTrue(issubclass(pyscm.DeadlineExceeded,
+            pyscm.BudgetExceeded))
+
+    def test_pairs(self):
+        code = "(define (grow l) (grow (cons 1 l))) (grow '())"
+        for run in (pyscm.run, pyscm.run_compiled, pyscm.run_explicit):
+            budget = pyscm.Budget(pairs=100)
+            self.assertRaises(pyscm.AllocationLimitExceeded, run, code,
+                pyscm.make_base(), budget=budget)
+            self.assertEqual(101, budget.pairs)
+        budget = pyscm.Budget()
+        self.assertEqual(6, pyscm.run('(car (list 6 7 8))',
+            pyscm.make_base(), budget=budget))
+        stats = budget.get_stats()
+        self.assertEqual((3, 2), (stats['pairs'], stats['calls']))
+        # code analyzed outside any budget is charged too
+        base = pyscm.make_base()
+        pyscm.run_compiled("(define (grow n l) "
+            "(if (= n 0) l (grow (- n 1) (cons n l))))", base)
+        budget = pyscm.Budget(pairs=100)
+        self.assertRaises(pyscm.AllocationLimitExceeded, pyscm.run_compiled,
+            '(grow 1000 (quote ()))', base, budget=budget)
+        self.assertEqual(101, budget.pairs)
+
+    def test_server(self):
+        server = pyscm.EvalServer(('127.0.0.1', 0), 1,
+            limits={'fuel': 10000})
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = 'http://127.0.0.1:%d/eval' % server.server_address[1]
+        try:
+            try:
+                urllib2.urlopen(url, self.loop)
+            except urllib2.HTTPError as e:
+                body = json.load(e)
+            self.assertIn('fuel', body['error'])
+            self.assertEqual(10001, body['cost']['fuel'])
+            body = json.load(urllib2.urlopen(url, '(+ 1 2)'))
+            self.assertEqual('3', body['value'])
+            self.assertEqual(1, body['cost']['calls'])
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+class TestExpand(unittest.TestCase):
+
+    def test_derived_forms(self):
+        self.assertEqual(['begin', [['lambda', ['a'],
+            ['if', ['=', 'a', 1], 2, ['if', ['>', 'a', 1], 3]]], 1]],
+            pyscm.expand(pyscm.parse("(let ((a 1)) "
+                "(cond ((= a 1) 2) ((> a 1) 3)))")))
+        self.assertEqual(['lambda', [], ['define', 'x', 1], 'x'],
+            pyscm.expand(['lambda', [], ['begin', ['define', 'x', 1]], 'x']))
+
+    def test_body_built_once(self):
+        env = pyscm.make_base()
+        f = pyscm.run("(define (f x) (display x) x) f", env)
+        self.assertIs(f.get_sequence(), f.get_sequence())
+        self.assertEqual(['begin', ['display', 'x'], 'x'], f.get_sequence())
+
+    def test_syntax_rules(self):
+        code = """
+        (define-syntax swap! (syntax-rules ()
+          ((_ a b) (let ((tmp a)) (set! a b) (set! b tmp)))))
+        (define-syntax my-or (syntax-rules ()
+          ((_) #f)
+          ((_ e) e)
+          ((_ e r ...) (let ((t e)) (if t t (my-or r ...))))))
+        (define x 1)
+        (define y 2)
+        (swap! x y)
+        (list x y (my-or #f 3) (my-or))
+        """
+        for run in (pyscm.run, pyscm.run_compiled, pyscm.run_explicit):
+            self.assertEqual('(2 1 3 #f)',
+                pyscm.to_string(run(code, pyscm.make_base())))
+
+    def test_literals(self):
+        env = pyscm.make_base()
+        pyscm.run("(define-syntax arrow (syntax-rules (=>) "
+            "((_ a => b) (list a b)) ((_ a b) a)))", env)
+        self.assertEqual('(1 2)', pyscm.to_string(
+            pyscm.run("(arrow 1 => 2)", env)))
+        self.assertEqual(1, pyscm.run("(arrow 1 2)", env))
+        self.assertRaises(Exception, pyscm.run, "(arrow 1 2 3)", env)
+
+    def test_macros_apart(self):
+        env = pyscm.make_base()
+        pyscm.run("(define-syntax two (syntax-rules () ((_) 2)))", env)
+        self.assertEqual(['two'], env.macros.keys())
+        self.assertNotIn('**macros**', env)
+        copy = pyscm.loads(pyscm.dumps(env))
+        self.assertEqual(len(env), len(copy))
+        self.assertEqual({}, copy.macros)
+        self.assertEqual(2, pyscm.run("(define-syntax two (syntax-rules () "
+            "((_) 2))) (two)", {}))
+
+class TestTiering(unittest.TestCase):
+
+    code = """
+    (define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+    (define (loop n acc) (if (= n 0) acc (loop (- n 1) (+ acc 1))))
+    (define (even? n) (if (= n 0) #t (odd? (- n 1))))
+    (define (odd? n) (if (= n 0) #f (even? (- n 1))))
+    """
+
+    def setUp(self):
+        self.env = pyscm.make_base()
+        pyscm.run(self.code, self.env)
+
+    def test_specialize(self):
+        self.assertEqual(6765, pyscm.run("(fib 20)", self.env))
+        self.assertEqual(100000, pyscm.run("(loop 100000 0)", self.env))
+        fib = self.env['fib']
+        self.assertIsNot(None, fib.specialized)
+        self.assertEqual((int,), fib.signature)
+        stats = [s for s in pyscm.tiering_stats()
+            if s['name'] == 'fib' and s['active']]
+        self.assertEqual(['int'], stats[0]['types'])
+        self.assertEqual(0, stats[0]['deopts'])
+        self.assertIsNot(None, self.env['loop'].specialized)
+
+    def test_deoptimize(self):
+        pyscm.run("(fib 20)", self.env)
+        fib = self.env['fib']
+        self.assertEqual(38.0, pyscm.run("(fib 8.5)", self.env))
+        self.assertTrue(fib.deopts > 0)
+        for i in range(pyscm.MAX_DEOPTS):
+            pyscm.run("(fib 1.5)", self.env)
+        self.assertIs(None, fib.specialized)
+        self.assertEqual(610, pyscm.run("(fib 15)", self.env))
+
+    def test_not_specialized(self):
+        # tail calls to another procedure must not grow the Python stack
+        self.assertIs(pyscm.TRUE, pyscm.run("(even? 20000)", self.env))
+        self.assertIs(None, self.env['even?'].specialized)
+        # redefining the procedure leaves the old version to the guard
+        pyscm.run("(fib 20)", self.env)
+        pyscm.run("(define (fib n) 0)", self.env)
+        self.assertEqual(0, pyscm.run("(fib 20)", self.env))
+        # so does redefining a primitive it inlines
+        pyscm.run("(define (f a b) (+ a b))", self.env)
+        for i in range(pyscm.HOT_CALLS + 10):
+            pyscm.run("(f 1 2)", self.env)
+        self.assertIsNot(None, self.env['f'].specialized)
+        pyscm.run("(define (+ a b) 42)", self.env)
+        self.assertEqual(42, pyscm.run("(f 1 2)", self.env))
+        budget = pyscm.Budget()
+        pyscm.run("(loop 1000 0)", self.env, budget=budget)
+        self.assertIs(None, self.env['loop'].specialized)
+
+    def test_optimized(self):
+        code = """
+        (define (sign x) (if (> x 0) 'pos 'neg))
+        (define (first x) (+ x (car '(1 2))))
+        """
+        pyscm.run(code, self.env, optimized=True)
+        for i in range(pyscm.HOT_CALLS + 10):
+            self.assertEqual('(pos 2)', pyscm.to_string(pyscm.run(
+                "(list (sign 1) (first 1))", self.env, optimized=True)))
+        self.assertIsNot(None, self.env['sign'].specialized)
+        self.assertIsNot(None, self.env['first'].specialized)
+        self.assertIs(pyscm.make_symbol('neg'),
+            pyscm.run("(sign -1)", self.env, optimized=True))
+
+    def test_pickle(self):
+        pyscm.run("(fib 20)", self.env)
+        fib = pyscm.loads(pyscm.dumps(self.env['fib']))
+        self.assertIs(None, fib.specialized)
+        self.assertEqual(0, fib.calls)
+
+class TestTranspile(unittest.TestCase):
+
+    def compiled_result(self, code):
+        namespace = {}
+        exec compile(pyscm.compile_to_python(code), '<scheme>', 'exec') \
+            in namespace
+        return namespace['result']
+
+    def assertSameResult(self, code):
+        self.assertEqual(pyscm.to_string(pyscm.run(code, pyscm.make_base())),
+            pyscm.to_string(self.compiled_result(code)))
+
+    def test_programs(self):
+        self.assertSameResult("(define (fib n) (if (< n 2) n "
+            "(+ (fib (- n 1)) (fib (- n 2))))) (fib 15)")
+        self.assertSameResult("(define (f x) (let ((y (* x 2)) (z 3)) "
+            "(cond ((> y 10) 'big) ((= y 4) \"four\") (else (list y z))))) "
+            "(list (f 10) (f 2) (f 1))")
+        self.assertSameResult("(define-memoized (fib n) (if (< n 2) n "
+            "(+ (fib (- n 1)) (fib (- n 2))))) (fib 60)")
+        self.assertSameResult("(define (even? n) (if (= n 0) #t "
+            "(odd? (- n 1)))) (define (odd? n) (if (= n 0) #f "
+            "(even? (- n 1)))) (even? 100)")
+
+    def test_closures(self):
+        self.assertSameResult("(define (make-counter) (define n 0) "
+            "(lambda () (set! n (+ n 1)) n)) (define c (make-counter)) "
+            "(c) (c) (c)")
+        self.assertSameResult("(define x 5) (set! x (+ x 1)) "
+            "((lambda (a) (* a x)) 2)")
+
+    def test_tail_loop(self):
+        code = ("(define (loop n acc) (if (= n 0) acc "
+            "(loop (- n 1) (+ acc 1)))) (loop 100000 0)")
+        self.assertIn('while True:', pyscm.compile_to_python(code))
+        self.assertEqual(100000, self.compiled_result(code))
+
+    def test_tail_calls(self):
+        self.assertIs(pyscm.TRUE, self.compiled_result("(define (ev? n) "
+            "(if (= n 0) #t (od? (- n 1)))) (define (od? n) (if (= n 0) #f "
+            "(ev? (- n 1)))) (ev? 100000)"))
+        self.assertSameResult("(define (f k n) (if (= n 0) 'done "
+            "(k (lambda () (f k (- n 1)))))) (define (g thunk) (thunk)) "
+            "(list (f g 100000) (force (delay (f g 10))))")
+        code = ("(define (f n) (define (g m) (if (= m 0) n (g (- m 1)))) "
+            "(g n)) (f 10)")
+        self.assertIn('TailCall(', pyscm.compile_to_python(code))
+        self.assertEqual(10, self.compiled_result(code))
+
+    def test_defined_late(self):
+        self.assertSameResult("(define (f x) (+ x 1)) (define a (f 1)) "
+            "(define (+ a b) 42) (list a (f 1))")
+        code = "(define (f x) (g x)) (define (g x) (* x 2)) (f 3)"
+        self.assertIn("env['g']", pyscm.compile_to_python(code))
+        self.assertEqual(6, self.compiled_result(code))
+
+    def test_compile_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'count.scm')
+            with open(path, 'w') as f:
+                f.write("(define (count n) (if (= n 0) 'done "
+                    "(count (- n 1)))) (count 10)")
+            self.assertEqual(os.path.join(directory, 'count.py'),
+                pyscm.compile_file(path))
+            self.assertTrue(os.path.exists(
+                os.path.join(directory, 'count.pyc')))
+            sys.path.insert(0, directory)
+            try:
+                import count
+                self.assertIs(pyscm.make_symbol('done'), count.result)
+            finally:
+                sys.path.remove(directory)
+                sys.modules.pop('count', None)
+        finally:
+            shutil.rmtree(directory)
+
+class TestAnalyze(unittest.TestCase):
+
+    def test_primitive_and_variable(self):
+        self.assertEqual(3, pyscm.analyze(3)({}))
+        self.assertEqual("hello", pyscm.analyze(pyscm.String('hello'))({}))
+        self.assertEqual(3, pyscm.analyze('a')({'**parent**':{'a':3}}))
+        self.assertRaises(Exception, pyscm.analyze('a'), {})
+
+    def test_definition_and_set(self):
+        env = {}
+        pyscm.analyze(['define', 'a', 3])(env)
+        self.assertEqual(3, env['a'])
+        pyscm.analyze(['define', ['f', 'x'], ['set!', 'a', 'x']])(env)
+        self.assertTrue(isinstance(env['f'], pyscm.Lambda))
+        pyscm.analyze(['f', 9])(env)
+        self.assertEqual(9, env['a'])
+
+    def test_apply(self):
+        code = """
+        (define (sum lst)
+            (if (eq? lst '())
+                0
+                (+ (car lst) (sum (cdr lst)))))
+        (define (map f lst)
+            (if (eq? lst '())
+                '()
+                (cons (f (car lst)) (map f (cdr lst)))))
+        (define (f x)
+            (cond
+                ((< x 3) 1)
+                (else (let ((y 2)) (* x y)))))
+        (+ (sum (map car '((1 2 3) (4 5 6)))) (f 1) (f 10))
+        """
+        self.assertEqual(26, pyscm.run_compiled(code, pyscm.make_base()))
+
+    def test_tail(self):
+        code = """
+        (define (sum2 n acc)
+            (if (= n 0)
+            acc
+            (sum2 (- n 1) (+ n acc))))
+        (sum2 20000 0)
+        """
+        self.assertEqual(200010000,
+            pyscm.run_compiled(code, pyscm.make_base()))
+
+    def test_lexical_addressing(self):
+        code = """
+        (define counter 0)
+        (define (make-adder n)
+            (lambda (x)
+                (set! counter (+ counter 1))
+                (set! n (+ n 1))
+                (+ x n)))
+        (define (outer a)
+            (define (even? n) (if (= n 0) #t (odd? (- n 1))))
+            (define (odd? n) (if (= n 0) #f (even? (- n 1))))
+            (let ((b 2))
+                (let ((c 3))
+                    (if (even? a) (+ a b c) 0))))
+        (define add5 (make-adder 4))
+        (add5 1)
+        (+ (add5 1) (outer 10) counter)
+        """
+        base = pyscm.make_base()
+        self.assertEqual(24, pyscm.run_compiled(code, base))
+        self.assertEqual(2, base['counter'])
+        env = {'**parent**': base}
+        pyscm.run_compiled('(define (g) (set! counter 7)) (g)', env)
+        self.assertEqual(7, base['counter'])
+        self.assertRaises(Exception, pyscm.run_compiled,
+            '(define (h) (define x y) (define y 1) x) (h)', base)
+
+    def test_closure_conversion(self):
+        base = pyscm.make_base()
+        add = pyscm.run_compiled('''
+        (define (make-adder n)
+            (define big (list 1 2 3))
+            (let ((unused big))
+                (lambda (x) (+ x n))))
+        (make-adder 5)''', base)
+        # only the variable used is captured, not the frames around it
+        self.assertEqual([5], add.free)
+        self.assertIs(base, add.top)
+        code = '''
+        (define (make-counter)
+            (define n 0)
+            (list (lambda () (set! n (+ n 1)) n) (lambda () n)))
+        (define c (make-counter))
+        ((car c))
+        ((car c))
+        ((car (cdr c)))
+        '''
+        self.assertEqual(2, pyscm.run_compiled(code, base))
+        counter = base['c'].car
+        self.assertTrue(isinstance(counter.free[0], pyscm.Cell))
+
+    def test_interop(self):
+        base = pyscm.make_base()
+        pyscm.run('(define (twice f x) (f (f x)))', base)
+        self.assertEqual(7, pyscm.run_compiled(
+            '(twice (lambda (x) (+ x 2)) 3)', base))
+        pyscm.run_compiled('(define (inc x) (+ x 1))', base)
+        self.assertEqual(5, pyscm.run('(twice inc 3)', base))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file